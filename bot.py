@@ -3,16 +3,19 @@ import os
 import re
 import json
 import time
-import random
 import threading
-from typing import Dict, Optional, List, Any
+from typing import Callable, Dict, Optional, List, Any
 from datetime import datetime, timedelta
 
 from telegram import Update, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler, MessageFilter
 from telegram.error import NetworkError, TimedOut, RetryAfter
 
 import db
+import intents
+import journal
+import persistence
+import stores
 
 # Enable logging
 logging.basicConfig(
@@ -45,6 +48,10 @@ GROUP_ADMINS = {}  # Format: {chat_id: set(user_ids)} - Group-specific admins
 # Message forwarding control
 FORWARDING_ENABLED = False  # Controls if messages can be forwarded from Group B to Group A
 
+# Held around every change to the configuration and while it is serialized, so the background
+# writer never sees a set or dict changing under it
+config_lock = threading.RLock()
+
 # Paths for persistent storage
 FORWARDED_MSGS_FILE = "forwarded_msgs.json"
 GROUP_B_RESPONSES_FILE = "group_b_responses.json"
@@ -56,17 +63,42 @@ SETTINGS_FILE = "bot_settings.json"
 GROUP_B_PERCENTAGES_FILE = "group_b_percentages.json"
 GROUP_B_CLICK_MODE_FILE = "group_b_click_mode.json"
 
+# Persistence engine for message state and config: "sqlite" keeps both in images.db (the JSON
+# files above are only read once, to import them); "journal" appends every change to
+# STATE_JOURNAL_FILE and periodically compacts it into STATE_SNAPSHOT_FILE
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_SNAPSHOT_FILE = "state_snapshot.json"
+STATE_JOURNAL_FILE = "state_journal.jsonl"
+state_journal = journal.StateJournal(STATE_SNAPSHOT_FILE, STATE_JOURNAL_FILE) if STATE_BACKEND == "journal" else None
+
+# Message state only keeps recent entries in memory; older ones are archived to images.db
+FORWARDED_MSGS_TTL_SECONDS = 3 * 24 * 3600
+FORWARDED_MSGS_MAX_ENTRIES = 20000
+GROUP_B_RESPONSES_TTL_SECONDS = 3 * 24 * 3600
+GROUP_B_RESPONSES_MAX_ENTRIES = 20000
+PENDING_CUSTOM_AMOUNTS_TTL_SECONDS = 7 * 24 * 3600
+PENDING_CUSTOM_AMOUNTS_MAX_ENTRIES = 2000
+
 # Message IDs mapping for forwarded messages
-forwarded_msgs: Dict[str, Dict] = {}
+forwarded_msgs = stores.ForwardIndex(
+    'forwarded_msgs', FORWARDED_MSGS_TTL_SECONDS, FORWARDED_MSGS_MAX_ENTRIES,
+    on_evict=lambda name, items: archive_evicted_state(name, items)
+)  # Format: {image_id: mapping}
 
 # Store Group B responses for each image
-group_b_responses: Dict[str, str] = {}
+group_b_responses = stores.BoundedStore(
+    'group_b_responses', GROUP_B_RESPONSES_TTL_SECONDS, GROUP_B_RESPONSES_MAX_ENTRIES,
+    on_evict=lambda name, items: archive_evicted_state(name, items)
+)  # Format: {image_id: response_text}
 
 # Store pending requests that need approval
 pending_requests: Dict[int, Dict] = {}
 
 # Store pending custom amount approvals from Group B
-pending_custom_amounts: Dict[int, Dict] = {}  # Format: {message_id: {img_id, amount, responder, original_msg_id}}
+pending_custom_amounts = stores.PendingApprovalStore(
+    'pending_custom_amounts', PENDING_CUSTOM_AMOUNTS_TTL_SECONDS, PENDING_CUSTOM_AMOUNTS_MAX_ENTRIES,
+    on_evict=lambda name, items: archive_evicted_state(name, items)
+)  # Format: {message_id: {img_id, amount, responder, original_msg_id}}
 
 # Store Group B percentage settings for image distribution
 group_b_percentages: Dict[int, int] = {}  # Format: {group_b_id: percentage}
@@ -117,130 +149,200 @@ def safe_reply_text(update, text, max_retries=3, retry_delay=2):
                 return None
 
 # Function to save all configuration data
-def save_config_data():
-    """Save all configuration data to files."""
-    # Save Group A IDs
-    try:
-        with open(GROUP_A_IDS_FILE, 'w') as f:
-            json.dump(list(GROUP_A_IDS), f, indent=2)
-            logger.info(f"Saved {len(GROUP_A_IDS)} Group A IDs to file")
-    except Exception as e:
-        logger.error(f"Error saving Group A IDs: {e}")
-    
-    # Save Group B IDs
-    try:
-        with open(GROUP_B_IDS_FILE, 'w') as f:
-            json.dump(list(GROUP_B_IDS), f, indent=2)
-            logger.info(f"Saved {len(GROUP_B_IDS)} Group B IDs to file")
-    except Exception as e:
-        logger.error(f"Error saving Group B IDs: {e}")
-    
-    # Save Group Admins
-    try:
-        # Convert sets to lists for JSON serialization
-        admins_json = {str(chat_id): list(user_ids) for chat_id, user_ids in GROUP_ADMINS.items()}
-        with open(GROUP_ADMINS_FILE, 'w') as f:
-            json.dump(admins_json, f, indent=2)
-            logger.info(f"Saved group admins to file")
-    except Exception as e:
-        logger.error(f"Error saving group admins: {e}")
-    
-    # Save Bot Settings
-    try:
-        settings = {
-            "forwarding_enabled": FORWARDING_ENABLED
+def config_values() -> Dict[str, Any]:
+    """Current configuration as JSON-serializable values, one entry per setting."""
+    with config_lock:
+        return {
+            'group_a_ids': sorted(GROUP_A_IDS),
+            'group_b_ids': sorted(GROUP_B_IDS),
+            'group_admins': [[chat_id, sorted(user_ids)] for chat_id, user_ids in GROUP_ADMINS.items()],
+            'forwarding_enabled': FORWARDING_ENABLED,
+            'group_b_percentages': [[group_id, percentage] for group_id, percentage in group_b_percentages.items()],
+            'group_b_click_mode': [[group_id, is_click_mode] for group_id, is_click_mode in group_b_click_mode.items()]
         }
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(settings, f, indent=2)
-            logger.info(f"Saved bot settings to file")
-    except Exception as e:
-        logger.error(f"Error saving bot settings: {e}")
-    
-    # Save Group B Percentages
-    try:
-        with open(GROUP_B_PERCENTAGES_FILE, 'w') as f:
-            json.dump(group_b_percentages, f, indent=2)
-            logger.info(f"Saved Group B percentages to file")
-    except Exception as e:
-        logger.error(f"Error saving Group B percentages: {e}")
-    
-    # Save Group B Click Mode Settings
-    try:
-        with open(GROUP_B_CLICK_MODE_FILE, 'w') as f:
-            json.dump(group_b_click_mode, f, indent=2)
-            logger.info(f"Saved Group B click mode settings to file")
-    except Exception as e:
-        logger.error(f"Error saving Group B click mode settings: {e}")
 
-# Function to load all configuration data
-def load_config_data():
-    """Load all configuration data from files."""
+def apply_config_values(values: Dict[str, Any]) -> None:
+    """Load configuration produced by config_values()."""
     global GROUP_A_IDS, GROUP_B_IDS, GROUP_ADMINS, FORWARDING_ENABLED, group_b_percentages, group_b_click_mode
     
-    # Load Group A IDs
-    if os.path.exists(GROUP_A_IDS_FILE):
-        try:
-            with open(GROUP_A_IDS_FILE, 'r') as f:
-                # Convert all IDs to integers
-                GROUP_A_IDS = set(int(x) for x in json.load(f))
-                logger.info(f"Loaded {len(GROUP_A_IDS)} Group A IDs from file")
-        except Exception as e:
-            logger.error(f"Error loading Group A IDs: {e}")
+    # Build everything first, then swap it in with a single assignment. Mutations take config_lock
+    # and look the globals up inside it, so none can land in a set or dict that is being replaced.
+    new_state = (
+        set(int(x) for x in values.get('group_a_ids', [])),
+        set(int(x) for x in values.get('group_b_ids', [])),
+        {int(chat_id): set(user_ids) for chat_id, user_ids in values.get('group_admins', [])},
+        values.get('forwarding_enabled', False),
+        {int(group_id): percentage for group_id, percentage in values.get('group_b_percentages', [])},
+        {int(group_id): is_click_mode for group_id, is_click_mode in values.get('group_b_click_mode', [])}
+    )
+    with config_lock:
+        (GROUP_A_IDS, GROUP_B_IDS, GROUP_ADMINS, FORWARDING_ENABLED,
+         group_b_percentages, group_b_click_mode) = new_state
+
+def save_config_data(*keys: str):
+    """Schedule the given configuration keys (all keys if none are given) to be saved to the config store.
+    
+    Call with config_lock held, naming every setting the caller changed.
+    """
+    if state_journal is not None:
+        values = config_values()
+        for key in keys or values:
+            state_journal.set('config', key, values[key])
+        return
     
-    # Load Group B IDs
-    if os.path.exists(GROUP_B_IDS_FILE):
+    # The background writer coalesces bursts into one config store commit
+    with config_lock:
+        config_dirty_keys.update(keys or config_values())
+        config_writer.mark_dirty()
+
+def dirty_config_values() -> Dict[str, Any]:
+    """Take the locally changed configuration keys and their current values for the writer."""
+    global config_dirty_keys
+    with config_lock:
+        keys, config_dirty_keys = config_dirty_keys, set()
+        values = config_values()
+        return {key: values[key] for key in keys}
+
+# Configuration is written by a single background thread, never by handlers. Only keys changed
+# locally are written, so settings another process committed in the meantime are not reverted.
+config_dirty_keys = set()
+config_writer = persistence.PersistenceWriter()
+config_writer.register('config', dirty_config_values, "configuration", write=lambda values: write_config(values))
+
+# Config store version currently applied in memory (see watch_config)
+config_version = 0
+CONFIG_WATCH_INTERVAL_SECONDS = 5.0
+config_watcher_stop = threading.Event()
+config_watcher_thread = None
+
+def write_config(values: Dict[str, Any]) -> Optional[int]:
+    """Commit configuration keys to the store, remembering the version so the watcher skips our own writes."""
+    global config_version
+    if not values:
+        return config_version
+    result = db.save_config(values)
+    if result is None:
+        # Keep the keys dirty so the writer's retry writes them again
+        with config_lock:
+            config_dirty_keys.update(values)
+        return None
+    
+    previous, version = result
+    # If someone else committed since we last loaded, leave the version behind so the watcher
+    # still picks up their changes
+    if previous == config_version:
+        config_version = version
+    return version
+
+def reload_config_if_changed() -> bool:
+    """Apply configuration committed by another process (or by hand) since we last loaded or wrote it."""
+    global config_version
+    if db.get_config_version() == config_version:
+        return False
+    
+    # Handlers mark the writer dirty while holding config_lock, so no local change can slip in
+    # between this check and the swap below
+    with config_lock:
+        # Local changes not yet written (or being written) win; they will be committed on top
+        if config_writer.pending:
+            return False
+        values, version = db.load_config()
+        if not values:
+            return False
+        apply_config_values(values)
+        config_version = version
+    logger.info(f"Reloaded configuration version {version}: Group A IDs {GROUP_A_IDS}, Group B IDs {GROUP_B_IDS}, "
+                f"percentages {group_b_percentages}")
+    return True
+
+def watch_config() -> None:
+    """Poll the config store's change counter and hot-reload on changes."""
+    while not config_watcher_stop.wait(CONFIG_WATCH_INTERVAL_SECONDS):
         try:
-            with open(GROUP_B_IDS_FILE, 'r') as f:
-                # Convert all IDs to integers
-                GROUP_B_IDS = set(int(x) for x in json.load(f))
-                logger.info(f"Loaded {len(GROUP_B_IDS)} Group B IDs from file")
+            reload_config_if_changed()
         except Exception as e:
-            logger.error(f"Error loading Group B IDs: {e}")
-    
-    # Load Group Admins
-    if os.path.exists(GROUP_ADMINS_FILE):
+            logger.error(f"Error reloading configuration: {e}")
+
+def start_config_watcher() -> None:
+    """Start the config hot-reload thread (the SQLite config store only)."""
+    global config_watcher_thread
+    if state_journal is not None:
+        logger.info("Config hot-reload is not available with the journal state engine")
+        return
+    config_watcher_thread = threading.Thread(target=watch_config, name="config-watcher", daemon=True)
+    config_watcher_thread.start()
+
+# Legacy per-setting config files: (path, config key, description)
+LEGACY_CONFIG_FILES = (
+    (GROUP_A_IDS_FILE, 'group_a_ids', "Group A IDs"),
+    (GROUP_B_IDS_FILE, 'group_b_ids', "Group B IDs"),
+    (GROUP_ADMINS_FILE, 'group_admins', "group admins"),
+    (SETTINGS_FILE, 'forwarding_enabled', "bot settings"),
+    (GROUP_B_PERCENTAGES_FILE, 'group_b_percentages', "Group B percentages"),
+    (GROUP_B_CLICK_MODE_FILE, 'group_b_click_mode', "Group B click mode settings"),
+)
+
+def load_legacy_config_files() -> Dict[str, Any]:
+    """Read the pre-config-store JSON files into config_values() form, keeping defaults for missing files."""
+    values = config_values()
+    for path, key, description in LEGACY_CONFIG_FILES:
+        if not os.path.exists(path):
+            continue
         try:
-            with open(GROUP_ADMINS_FILE, 'r') as f:
-                admins_json = json.load(f)
-                # Convert keys back to integers and values back to sets
-                GROUP_ADMINS = {int(chat_id): set(user_ids) for chat_id, user_ids in admins_json.items()}
-                logger.info(f"Loaded group admins from file")
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if key == 'forwarding_enabled':
+                values[key] = data.get("forwarding_enabled", False)
+            elif isinstance(data, dict):
+                # JSON object keys are strings; the config store keeps [id, value] pairs
+                values[key] = [[int(k), v] for k, v in data.items()]
+            else:
+                values[key] = data
+            logger.info(f"Read legacy {description} from {path}")
         except Exception as e:
-            logger.error(f"Error loading group admins: {e}")
+            logger.error(f"Error loading legacy {description}: {e}")
+    return values
+
+# Function to load all configuration data
+def load_config_data():
+    """Load all configuration data from the config store in one read."""
+    global config_version
+    
+    if state_journal is not None:
+        state_journal.load()
+        config = state_journal.namespace('config')
+        if config:
+            apply_config_values(config)
+            logger.info(f"Loaded configuration from state journal: Group A IDs {GROUP_A_IDS}, Group B IDs {GROUP_B_IDS}")
+            return
+        # First start on the journal engine: seed it from the SQLite config store
+        config, _ = db.load_config()
+    else:
+        config, version = db.load_config()
+        if config:
+            apply_config_values(config)
+            config_version = version
+            logger.info(f"Loaded configuration version {version}: Group A IDs {GROUP_A_IDS}, Group B IDs {GROUP_B_IDS}")
+            return
     
-    # Load Bot Settings
-    if os.path.exists(SETTINGS_FILE):
-        try:
-            with open(SETTINGS_FILE, 'r') as f:
-                settings = json.load(f)
-                FORWARDING_ENABLED = settings.get("forwarding_enabled", False)
-                logger.info(f"Loaded bot settings: forwarding_enabled={FORWARDING_ENABLED}")
-        except Exception as e:
-            logger.error(f"Error loading bot settings: {e}")
+    # First start on the config store: import the six legacy JSON files once
+    imported_files = not config
+    if imported_files:
+        config = load_legacy_config_files()
+    apply_config_values(config)
     
-    # Load Group B Percentages
-    if os.path.exists(GROUP_B_PERCENTAGES_FILE):
-        try:
-            with open(GROUP_B_PERCENTAGES_FILE, 'r') as f:
-                percentages_json = json.load(f)
-                # Convert keys back to integers
-                group_b_percentages = {int(group_id): percentage for group_id, percentage in percentages_json.items()}
-                logger.info(f"Loaded Group B percentages from file: {group_b_percentages}")
-        except Exception as e:
-            logger.error(f"Error loading Group B percentages: {e}")
-            group_b_percentages = {}
+    stored = True
+    if state_journal is not None:
+        save_config_data()
+    else:
+        stored = write_config(config_values()) is not None
     
-    # Load Group B Click Mode Settings
-    if os.path.exists(GROUP_B_CLICK_MODE_FILE):
-        try:
-            with open(GROUP_B_CLICK_MODE_FILE, 'r') as f:
-                click_mode_json = json.load(f)
-                # Convert keys back to integers
-                group_b_click_mode = {int(group_id): is_click_mode for group_id, is_click_mode in click_mode_json.items()}
-                logger.info(f"Loaded Group B click mode settings from file: {group_b_click_mode}")
-        except Exception as e:
-            logger.error(f"Error loading Group B click mode settings: {e}")
-            group_b_click_mode = {}
+    if imported_files and stored:
+        # Move the imported files aside so they cannot be mistaken for the live configuration
+        for path, _, _ in LEGACY_CONFIG_FILES:
+            if os.path.exists(path):
+                os.replace(path, f"{path}.migrated")
+    logger.info(f"Initialized configuration store: Group A IDs {GROUP_A_IDS}, Group B IDs {GROUP_B_IDS}")
 
 # Check if user is a global admin
 def is_global_admin(user_id):
@@ -260,74 +362,140 @@ def is_group_admin(user_id, chat_id):
 # Add group admin
 def add_group_admin(user_id, chat_id):
     """Add a user as a group admin for a specific chat."""
-    if chat_id not in GROUP_ADMINS:
-        GROUP_ADMINS[chat_id] = set()
-    
-    GROUP_ADMINS[chat_id].add(user_id)
-    save_config_data()
+    with config_lock:
+        if chat_id not in GROUP_ADMINS:
+            GROUP_ADMINS[chat_id] = set()
+        
+        GROUP_ADMINS[chat_id].add(user_id)
+        save_config_data('group_admins')
     logger.info(f"Added user {user_id} as group admin for chat {chat_id}")
 
+def load_legacy_json_state() -> tuple:
+    """Read the pre-SQLite JSON state files, returning (forwarded_msgs, group_b_responses, pending_custom_amounts)."""
+    legacy = []
+    for path, description in ((FORWARDED_MSGS_FILE, "forwarded messages"),
+                              (GROUP_B_RESPONSES_FILE, "Group B responses"),
+                              (PENDING_CUSTOM_AMOUNTS_FILE, "pending custom amounts")):
+        data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                    logger.info(f"Read {len(data)} legacy {description} from {path}")
+            except Exception as e:
+                logger.error(f"Error loading legacy {description}: {e}")
+        legacy.append(data)
+    
+    forwarded, responses, pending = legacy
+    # Convert string keys back to integers
+    return forwarded, responses, {int(k): v for k, v in pending.items()}
+
 # Load persistent data on startup
 def load_persistent_data():
-    global forwarded_msgs, group_b_responses, pending_custom_amounts
+    if state_journal is not None:
+        state_journal.load()
+        # Entries keep the write time they were journaled with, so their TTL runs across restarts
+        for store in (forwarded_msgs, group_b_responses, pending_custom_amounts):
+            store.load(state_journal.items(store.name))
+        
+        # First start on the journal engine: seed it from the SQLite tables, write times included
+        if not (forwarded_msgs or group_b_responses or pending_custom_amounts):
+            for store in (forwarded_msgs, group_b_responses, pending_custom_amounts):
+                rows = db.load_message_state(store.name)
+                for key, value, updated_at in rows:
+                    state_journal.set(store.name, key, value, stamp=updated_at)
+                store.load(rows)
+        
+        logger.info(f"Loaded {len(forwarded_msgs)} forwarded messages, {len(group_b_responses)} Group B responses "
+                    f"and {len(pending_custom_amounts)} pending custom amounts from state journal")
+        load_config_data()
+        return
     
-    # Load forwarded_msgs
-    if os.path.exists(FORWARDED_MSGS_FILE):
-        try:
-            with open(FORWARDED_MSGS_FILE, 'r') as f:
-                forwarded_msgs = json.load(f)
-                logger.info(f"Loaded {len(forwarded_msgs)} forwarded messages from file")
-        except Exception as e:
-            logger.error(f"Error loading forwarded messages: {e}")
+    # Archive rows that expired while the bot was down before loading the working set
+    for store in (forwarded_msgs, group_b_responses, pending_custom_amounts):
+        db.expire_message_state(store.name, store.ttl_seconds)
     
-    # Load group_b_responses
-    if os.path.exists(GROUP_B_RESPONSES_FILE):
-        try:
-            with open(GROUP_B_RESPONSES_FILE, 'r') as f:
-                group_b_responses = json.load(f)
-                logger.info(f"Loaded {len(group_b_responses)} Group B responses from file")
-        except Exception as e:
-            logger.error(f"Error loading Group B responses: {e}")
+    for store in (forwarded_msgs, group_b_responses, pending_custom_amounts):
+        store.load(db.load_message_state(store.name))
     
-    # Load pending_custom_amounts
-    if os.path.exists(PENDING_CUSTOM_AMOUNTS_FILE):
-        try:
-            with open(PENDING_CUSTOM_AMOUNTS_FILE, 'r') as f:
-                # Convert string keys back to integers
-                data = json.load(f)
-                pending_custom_amounts = {int(k): v for k, v in data.items()}
-                logger.info(f"Loaded {len(pending_custom_amounts)} pending custom amounts from file")
-        except Exception as e:
-            logger.error(f"Error loading pending custom amounts: {e}")
+    # First start after the move to SQLite: import the old JSON files once
+    if not (forwarded_msgs or group_b_responses or pending_custom_amounts):
+        forwarded, responses, pending = load_legacy_json_state()
+        if (forwarded or responses or pending) and db.import_message_state(forwarded, responses, pending):
+            for store in (forwarded_msgs, group_b_responses, pending_custom_amounts):
+                store.load(db.load_message_state(store.name))
+            # Move the imported files aside so an emptied database is not re-seeded from them
+            for path in (FORWARDED_MSGS_FILE, GROUP_B_RESPONSES_FILE, PENDING_CUSTOM_AMOUNTS_FILE):
+                if os.path.exists(path):
+                    os.replace(path, f"{path}.migrated")
+    
+    logger.info(f"Loaded {len(forwarded_msgs)} forwarded messages, {len(group_b_responses)} Group B responses "
+                f"and {len(pending_custom_amounts)} pending custom amounts")
     
     # Load configuration data
     load_config_data()
 
-# Save persistent data
-def save_persistent_data():
-    # Save forwarded_msgs
-    try:
-        with open(FORWARDED_MSGS_FILE, 'w') as f:
-            json.dump(forwarded_msgs, f, indent=2)
-            logger.info(f"Saved {len(forwarded_msgs)} forwarded messages to file")
-    except Exception as e:
-        logger.error(f"Error saving forwarded messages: {e}")
-    
-    # Save group_b_responses
-    try:
-        with open(GROUP_B_RESPONSES_FILE, 'w') as f:
-            json.dump(group_b_responses, f, indent=2)
-            logger.info(f"Saved {len(group_b_responses)} Group B responses to file")
-    except Exception as e:
-        logger.error(f"Error saving Group B responses: {e}")
-    
-    # Save pending_custom_amounts
-    try:
-        with open(PENDING_CUSTOM_AMOUNTS_FILE, 'w') as f:
-            json.dump(pending_custom_amounts, f, indent=2)
-            logger.info(f"Saved {len(pending_custom_amounts)} pending custom amounts to file")
-    except Exception as e:
-        logger.error(f"Error saving pending custom amounts: {e}")
+def archive_evicted_state(namespace: str, items: List) -> None:
+    """Move entries evicted from a message-state store to the archive table."""
+    if state_journal is not None:
+        db.archive_message_state(namespace, items, delete_hot=False)
+        for key, _ in items:
+            state_journal.delete(namespace, key)
+    else:
+        db.archive_message_state(namespace, items)
+
+def find_forwarded_msg(image_id: str) -> Optional[Dict]:
+    """Get the forwarded message mapping of an image, falling back to the archive."""
+    msg_data = forwarded_msgs.get(image_id)
+    if msg_data is None:
+        msg_data = db.get_archived_state('forwarded_msgs', image_id)
+        if msg_data is not None:
+            logger.info(f"Found archived forwarded message mapping for image {image_id}")
+    return msg_data
+
+def find_forwarded_msg_for_button(query, image_id: str) -> tuple:
+    """Resolve (image_id, mapping) for a button press from the Group B message it is attached to,
+    falling back to the image ID in the callback data."""
+    match = forwarded_msgs.find_by_group_b_msg(query.message.chat_id, query.message.message_id)
+    if match:
+        return match
+    return image_id, find_forwarded_msg(image_id)
+
+# Message state changes are written to SQLite one row at a time as they happen
+def store_forwarded_msg(image_id: str, data: Dict) -> None:
+    """Record the forwarded message mapping of an image."""
+    written = forwarded_msgs.put(image_id, data)
+    if state_journal is not None:
+        state_journal.set('forwarded_msgs', image_id, data, stamp=written)
+    else:
+        db.save_forwarded_msg(image_id, data, updated_at=written)
+
+def store_group_b_response(image_id: str, response_text: str) -> None:
+    """Record the Group B response for an image."""
+    written = group_b_responses.put(image_id, response_text)
+    if state_journal is not None:
+        state_journal.set('group_b_responses', image_id, response_text, stamp=written)
+    else:
+        db.save_group_b_response(image_id, response_text, updated_at=written)
+
+def store_pending_custom_amount(message_id: int, data: Dict) -> None:
+    """Record a custom amount waiting for global admin approval."""
+    written = pending_custom_amounts.put(message_id, data)
+    if state_journal is not None:
+        state_journal.set('pending_custom_amounts', message_id, data, stamp=written)
+    else:
+        db.save_pending_custom_amount(message_id, data, updated_at=written)
+
+def remove_pending_custom_amount(message_id: int) -> bool:
+    """Forget a pending custom amount approval, returning whether it existed."""
+    if message_id not in pending_custom_amounts:
+        return False
+    del pending_custom_amounts[message_id]
+    if state_journal is not None:
+        state_journal.delete('pending_custom_amounts', message_id)
+    else:
+        db.delete_pending_custom_amount(message_id)
+    return True
 
 def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
@@ -376,7 +544,10 @@ def help_command(update: Update, context: CallbackContext) -> None:
 /setgroupbpercent <group_b_id> <percentage> - Set percentage chance (0-100) for a Group B
 /resetgroupbpercent - Reset all Group B percentages to normal
 /listgroupbpercent - List all Group B percentage settings
+/groupbshare - Configured vs realised share per Group B
 /debug - Debug information
+/dbstats - Database connection and cache statistics
+/inventory - Open/closed image counts per Group B
 /dreset - Reset all image statuses
 """
 
@@ -405,10 +576,17 @@ def set_image(update: Update, context: CallbackContext) -> None:
         return
     
     # Get the file_id of the image
-    file_id = update.message.reply_to_message.photo[-1].file_id
-    image_id = f"img_{len(db.get_all_images()) + 1}"
+    photo = update.message.reply_to_message.photo[-1]
+    file_id = photo.file_id
+    
+    existing = db.get_image_by_file_unique_id(photo.file_unique_id)
+    if existing:
+        update.message.reply_text(f"This image is already set as {existing['image_id']} with number {existing['number']}.")
+        return
+    
+    image_id = db.allocate_image_id()
     
-    if db.add_image(image_id, number, file_id):
+    if db.add_image(image_id, number, file_id, file_unique_id=photo.file_unique_id):
         update.message.reply_text(f"Image set with number {number} and status 'open'.")
     else:
         update.message.reply_text("Failed to set image. It might already exist.")
@@ -422,25 +600,22 @@ def list_images(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("Only global admins can use this command.")
         return
     
-    images = db.get_all_images()
-    if not images:
-        update.message.reply_text("No images available.")
-        return
-    
     # Format the list of images
     image_list = []
-    for img in images:
-        status = img['status']
-        number = img['number']
-        image_id = img['image_id']
+    for img in db.iter_images():
+        status = img.status
+        number = img.number
+        image_id = img.image_id
         
-        # Get Group B ID from metadata if available
-        group_b_id = "none"
-        if 'metadata' in img and isinstance(img['metadata'], dict):
-            group_b_id = img['metadata'].get('source_group_b_id', "none")
+        # Group B ID comes from its indexed column, so no metadata decoding is needed
+        group_b_id = img.source_group_b_id if img.source_group_b_id is not None else "none"
         
         image_list.append(f"🔢 Group: {number} | 🆔 ID: {image_id} | ⚡ Status: {status} | 🔸 Group B: {group_b_id}")
     
+    if not image_list:
+        update.message.reply_text("No images available.")
+        return
+    
     # Join the list with newlines
     message = "📋 Available Images:\n\n" + "\n\n".join(image_list)
     
@@ -516,52 +691,22 @@ def handle_group_a_message(update: Update, context: CallbackContext) -> None:
         logger.info("Message starts with '+', skipping")
         return
     
-    # Match any of the formats:
-    # - Just a number
-    # - number+群 or number 群
-    # - 群+number or 群 number
-    # - 微信+number or 微信 number 
-    # - number+微信 or number 微信
-    # - 微信群+number or 微信群 number
-    # - number+微信群 or number 微信群
-    patterns = [
-        r'^(\d+)$',  # Just a number
-        r'^(\d+)\s*群$',  # number+群
-        r'^群\s*(\d+)$',  # 群+number
-        r'^微信\s*(\d+)$',  # 微信+number
-        r'^(\d+)\s*微信$',  # number+微信
-        r'^微信群\s*(\d+)$',  # 微信群+number
-        r'^(\d+)\s*微信群$',  # number+微信群
-        r'^微信\s*群\s*(\d+)$',  # 微信 群 number (with spaces)
-        r'^(\d+)\s*微信\s*群$'   # number 微信 群 (with spaces)
-    ]
-    
-    amount = None
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            amount = match.group(1)
-            logger.info(f"Matched pattern '{pattern}' with amount: {amount}")
-            break
-    
-    if not amount:
+    # Classified once by the handler's IntentFilter; only amount messages are handled here
+    intent = message_intent(update, context)
+    if intent.kind != intents.AMOUNT:
         logger.info("Message doesn't match any accepted format")
         return
+    amount = intent.value
+    logger.info(f"Matched amount: {amount}")
     
     # Check if the number is between 20 and 5000 (inclusive)
-    try:
-        amount_int = int(amount)
-        if amount_int < 20 or amount_int > 5000:
-            logger.info(f"Number {amount} is outside the allowed range (20-5000).")
-            return
-    except ValueError:
-        logger.info(f"Invalid number format: {amount}")
+    if amount < 20 or amount > 5000:
+        logger.info(f"Number {amount} is outside the allowed range (20-5000).")
         return
     
     # Rest of the function remains unchanged
     # Check if we have any images
-    images = db.get_all_images()
-    if not images:
+    if not db.has_images():
         logger.info("No images found in database - remaining silent")
         return
         
@@ -594,19 +739,19 @@ def handle_approval(update: Update, context: CallbackContext) -> None:
         
         logger.info(f"Found pending request: {request}")
         
-        # Get a random open image
-        image = db.get_random_open_image()
+        # Claim an open image - it is closed in the same transaction that selects it.
+        # With percentages configured, the fair-share dispatcher decides which Group B is due next.
+        strategy = db.CLAIM_FAIR_SHARE if group_b_percentages else db.CLAIM_RANDOM
+        image = db.claim_image(strategy, group_b_percentages=group_b_percentages)
         if not image:
             update.message.reply_text("No open images available.")
             return
         
-        logger.info(f"Selected image: {image['image_id']}")
+        logger.info(f"Claimed image: {image['image_id']}")
         
         # Send the image
         try:
-            # Get the image and its metadata
-            image = db.get_image_by_id(image['image_id'])
-            metadata = image.get('metadata', {}) if image else {}
+            metadata = image.get('metadata', {})
             
             # Get the proper Group B ID for this image
             target_group_b_id = get_group_b_for_image(image['image_id'], metadata)
@@ -647,7 +792,7 @@ def handle_approval(update: Update, context: CallbackContext) -> None:
             logger.info(f"Message forwarded to Group B with message_id: {forwarded.message_id}")
             
             # Store mapping between original and forwarded message
-            forwarded_msgs[image['image_id']] = {
+            store_forwarded_msg(image['image_id'], {
                 'group_a_msg_id': sent_msg.message_id,
                 'group_a_chat_id': update.effective_chat.id,
                 'group_b_msg_id': forwarded.message_id,
@@ -657,28 +802,23 @@ def handle_approval(update: Update, context: CallbackContext) -> None:
                 'number': str(image['number']),  # Store the image number as string
                 'original_user_id': request['user_id'],  # Store original user for more robust tracking
                 'original_message_id': request['original_message_id']  # Store the original message ID to reply to
-            }
+            })
             
             logger.info(f"Stored message mapping: {forwarded_msgs[image['image_id']]}")
             
-            # Save persistent data
-            save_persistent_data()
-            
-            # Set image status to closed
-            db.set_image_status(image['image_id'], "closed")
-            logger.info(f"Image {image['image_id']} status set to closed")
-            
             # Remove the pending request
             del pending_requests[request_msg_id]
         except Exception as e:
             logger.error(f"Error forwarding to Group B: {e}")
             update.message.reply_text(f"发送至Group B失败: {e}")
+            
+            # The image was never delivered, so put it back in the open pool and uncharge its Group B
+            db.release_claimed_image(image['image_id'], strategy, group_b_percentages)
     else:
         logger.info(f"No pending request found for message ID: {request_msg_id}")
 
 def handle_set_group_a(update: Update, context: CallbackContext) -> None:
     """Handle setting a group as Group A."""
-    global dispatcher
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
@@ -689,19 +829,15 @@ def handle_set_group_a(update: Update, context: CallbackContext) -> None:
         return
     
     # Add this chat to Group A - ensure we're storing as integer
-    GROUP_A_IDS.add(int(chat_id))
-    save_config_data()
-    
-    # Reload handlers to pick up the new group
-    if dispatcher:
-        register_handlers(dispatcher)
+    with config_lock:
+        GROUP_A_IDS.add(int(chat_id))
+        save_config_data('group_a_ids')
     
     logger.info(f"Group {chat_id} set as Group A by user {user_id}")
     # Notification removed
 
 def handle_set_group_b(update: Update, context: CallbackContext) -> None:
     """Handle setting a group as Group B."""
-    global dispatcher
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
@@ -712,12 +848,9 @@ def handle_set_group_b(update: Update, context: CallbackContext) -> None:
         return
     
     # Add this chat to Group B - ensure we're storing as integer
-    GROUP_B_IDS.add(int(chat_id))
-    save_config_data()
-    
-    # Reload handlers to pick up the new group
-    if dispatcher:
-        register_handlers(dispatcher)
+    with config_lock:
+        GROUP_B_IDS.add(int(chat_id))
+        save_config_data('group_b_ids')
     
     logger.info(f"Group {chat_id} set as Group B by user {user_id}")
     # Notification removed
@@ -748,19 +881,34 @@ def handle_promote_group_admin(update: Update, context: CallbackContext) -> None
     logger.info(f"User {target_user_id} promoted to group admin in chat {chat_id} by user {user_id}")
 
 def handle_set_group_image(update: Update, context: CallbackContext) -> None:
-    """Handle setting an image for a specific group number."""
+    """Handle setting an image for a specific group number.
+    
+    Photos are not stored one by one: they are queued per (chat, user) and flushed together
+    by flush_image_batch once the upload burst (or album) goes quiet.
+    """
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
     logger.info(f"Image setting attempt in chat {chat_id} by user {user_id}")
     
+    # Debug caption
+    caption = update.message.caption or ""
+    media_group_id = update.message.media_group_id
+    logger.info(f"Caption: '{caption}', media group: {media_group_id}")
+    
+    # Only photos captioned "设置群 N" get error replies; other album photos stay silent, since
+    # whether their album is a 设置群 upload is only known once the batch is flushed
+    group_number = message_intent(update, context, caption=True).value
+    is_explicit = group_number is not None
+    
     # Debug registered Group B chats
     logger.info(f"Current Group B chats: {GROUP_B_IDS}")
     
     # Check if this is a Group B chat
     if chat_id not in GROUP_B_IDS:
         logger.warning(f"User tried to set image in non-Group B chat: {chat_id}")
-        update.message.reply_text("此群聊未设置为需方群 (Group B)，请联系全局管理员设置。")
+        if is_explicit:
+            update.message.reply_text("此群聊未设置为需方群 (Group B)，请联系全局管理员设置。")
         return
     
     # Debug admin status
@@ -780,7 +928,8 @@ def handle_set_group_image(update: Update, context: CallbackContext) -> None:
     # Check if user is a group admin or global admin
     if not allow_all_users and not is_group_admin(user_id, chat_id) and not is_global_admin(user_id):
         logger.warning(f"User {user_id} tried to set image but is not an admin")
-        update.message.reply_text("只有群操作人可以设置图片。请联系管理员。")
+        if is_explicit:
+            update.message.reply_text("只有群操作人可以设置图片。请联系管理员。")
         return
     
     # Check if message has a photo
@@ -789,72 +938,132 @@ def handle_set_group_image(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("请发送一张图片并备注'设置群 {number}'。")
         return
     
-    # Debug caption
-    caption = update.message.caption or ""
-    logger.info(f"Caption: '{caption}'")
-    
-    # Extract group number from message text
-    match = re.search(r'设置群\s*(\d+)', caption)
-    if not match:
+    if group_number is None and not media_group_id:
         logger.warning(f"Caption doesn't match pattern: '{caption}'")
         update.message.reply_text("请使用正确的格式：设置群 {number}")
         return
     
-    group_number = match.group(1)
-    logger.info(f"Setting image for group {group_number}")
-    
-    # Get the file_id of the image
-    file_id = update.message.photo[-1].file_id
-    image_id = f"img_{int(time.time())}"  # Use timestamp for unique ID
-    
-    # Store which Group B chat this image came from
-    source_group_b_id = int(chat_id)  # Explicitly convert to int to ensure consistent type
-    logger.info(f"Setting image source Group B ID: {source_group_b_id}")
-    
-    # Find a target Group A for this Group B
-    target_group_a_id = None
+    # Uncaptioned album photos take the number from their album's caption when the batch is flushed
+    logger.info(f"Queueing image for group {group_number} (media group {media_group_id})")
+    
+    queue_image_upload(update, context, {
+        'file_id': update.message.photo[-1].file_id,
+        'file_unique_id': update.message.photo[-1].file_unique_id,
+        'number': group_number,
+        'media_group_id': media_group_id
+    })
+
+# Photo uploads are collected per (chat, user) and stored in one transaction once no new
+# photo has arrived for IMAGE_BATCH_WINDOW_SECONDS (or the batch reaches IMAGE_BATCH_MAX_SIZE)
+IMAGE_BATCH_WINDOW_SECONDS = 1.5
+IMAGE_BATCH_MAX_SIZE = 100
+
+pending_image_batches: Dict[tuple, Dict] = {}  # Format: {(chat_id, user_id): {entries, album_numbers, timer, context, reply_to}}
+image_batches_lock = threading.Lock()
+
+def queue_image_upload(update: Update, context: CallbackContext, entry: Dict) -> None:
+    """Add a photo to its sender's pending batch and (re)start the flush timer."""
+    key = (update.effective_chat.id, update.effective_user.id)
+    flush_now = False
+    
+    with image_batches_lock:
+        batch = pending_image_batches.setdefault(key, {
+            'entries': [],
+            'album_numbers': {},  # Format: {media_group_id: number from the album's caption}
+            'timer': None
+        })
+        batch['entries'].append(entry)
+        if entry['media_group_id'] and entry['number'] is not None:
+            batch['album_numbers'].setdefault(entry['media_group_id'], entry['number'])
+        batch['context'] = context
+        batch['reply_to'] = update.message.message_id
+        
+        if batch['timer']:
+            batch['timer'].cancel()
+        if len(batch['entries']) >= IMAGE_BATCH_MAX_SIZE:
+            flush_now = True
+        else:
+            batch['timer'] = threading.Timer(IMAGE_BATCH_WINDOW_SECONDS, flush_image_batch_on_timer, args=(key,))
+            batch['timer'].daemon = True
+            batch['timer'].start()
     
-    # First, check if we have a specific Group A that corresponds to this Group B
-    # For simplicity, we'll use the first Group A in the list
-    if GROUP_A_IDS:
-        target_group_a_id = next(iter(GROUP_A_IDS))
-    else:
-        target_group_a_id = GROUP_A_ID
+    if flush_now:
+        flush_image_batch(key)
+
+def flush_image_batch_on_timer(key: tuple) -> None:
+    """Timer thread entry point: flush the batch, then release the thread's database connection."""
+    try:
+        flush_image_batch(key)
+    finally:
+        db.close_thread_connection()
+
+def flush_image_batch(key: tuple) -> None:
+    """Store a pending photo batch with a single db.add_images call and send one summary reply."""
+    with image_batches_lock:
+        batch = pending_image_batches.pop(key, None)
+    if not batch:
+        return
     
-    logger.info(f"Setting image target Group A ID: {target_group_a_id}")
+    chat_id = key[0]
+    context = batch['context']
     
-    # Debug image data
-    logger.info(f"Image data - ID: {image_id}, file_id: {file_id}, group: {group_number}")
-    logger.info(f"Source Group B: {source_group_b_id}, Target Group A: {target_group_a_id}")
+    # Store which Group B chat these images came from and which Group A they target
+    source_group_b_id = int(chat_id)  # Explicitly convert to int to ensure consistent type
+    target_group_a_id = next(iter(GROUP_A_IDS)) if GROUP_A_IDS else GROUP_A_ID
+    metadata = json.dumps({
+        'source_group_b_id': source_group_b_id,
+        'target_group_a_id': target_group_a_id
+    })
+    logger.info(f"Flushing {len(batch['entries'])} images for Group B {source_group_b_id} with metadata: {metadata}")
+    
+    records = []
+    numbers = []
+    unnumbered = 0
+    for entry in batch['entries']:
+        number = entry['number']
+        if number is None:
+            # Any photo of the album may carry the caption, in any order
+            number = batch['album_numbers'].get(entry['media_group_id'])
+        if number is None:
+            # An album none of whose photos had a 设置群 caption is not an image upload
+            unnumbered += 1
+            continue
+        records.append((db.allocate_image_id(), number, entry['file_id'], 'open', metadata, entry['file_unique_id']))
+        numbers.append(str(number))
+    
+    if unnumbered:
+        logger.info(f"Ignoring {unnumbered} album photos without a '设置群 N' caption in their album")
+    if not records:
+        return
     
-    # Save the image with additional metadata
     try:
-        # Store the metadata in a separate JSON field - make sure source_group_b_id is explicitly an int
-        metadata_dict = {
-            'source_group_b_id': source_group_b_id,
-            'target_group_a_id': target_group_a_id
-        }
-        
-        # Convert to JSON string
-        metadata = json.dumps(metadata_dict)
+        added, duplicates = db.add_images(records)
+        failed = len(records) - added - duplicates
         
-        logger.info(f"Saving image with metadata: {metadata}")
-        
-        success = db.add_image(image_id, int(group_number), file_id, metadata=metadata)
-        if success:
-            # Double check that the image was set correctly
-            saved_image = db.get_image_by_id(image_id)
-            if saved_image and 'metadata' in saved_image:
-                logger.info(f"Verified image metadata: {saved_image['metadata']}")
-            
-            logger.info(f"Successfully added image {image_id} for group {group_number}")
-            update.message.reply_text(f"✅ 已设置群聊为{group_number}群")
+        if len(batch['entries']) == 1 and added == 1:
+            text = f"✅ 已设置群聊为{numbers[0]}群"
+        elif added == len(records):
+            text = f"✅ 已批量设置 {added} 张图片：群 {', '.join(numbers)}"
+        elif added:
+            text = f"✅ 已批量设置 {added} 张图片"
+        elif duplicates:
+            text = "设置图片失败，图片已存在。"
         else:
-            logger.error(f"Failed to add image {image_id} for group {group_number}")
-            update.message.reply_text("设置图片失败，该图片可能已存在。请重试。")
+            text = "设置图片失败，该图片可能已存在。请重试。"
+        if duplicates:
+            text += f"\n⚠️ {duplicates} 张重复图片已跳过。"
+        if failed:
+            text += f"\n⚠️ {failed} 张图片保存失败。"
+        
+        logger.info(f"Image batch for Group B {source_group_b_id}: {added} added, {duplicates} duplicates, {failed} failed, {unnumbered} without number")
+    except Exception as e:
+        logger.error(f"Exception when adding image batch: {e}")
+        text = f"设置图片时出错: {str(e)}"
+    
+    try:
+        safe_send_message(context, chat_id, text, reply_to_message_id=batch['reply_to'])
     except Exception as e:
-        logger.error(f"Exception when adding image: {e}")
-        update.message.reply_text(f"设置图片时出错: {str(e)}")
+        logger.error(f"Error sending image batch summary: {e}")
 
 def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_data, number) -> None:
     """Handle custom amount that needs approval."""
@@ -868,7 +1077,7 @@ def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_d
     logger.info(f"Custom amount detected: {number}")
     
     # Store the custom amount approval with more detailed info
-    pending_custom_amounts[message_id] = {
+    store_pending_custom_amount(message_id, {
         'img_id': img_id,
         'amount': number,
         'responder': user_id,
@@ -877,10 +1086,7 @@ def handle_custom_amount(update: Update, context: CallbackContext, img_id, msg_d
         'reply_to_msg_id': reply_to_message_id,  # The ID of the message being replied to
         'message_text': custom_message,
         'timestamp': datetime.now().isoformat()
-    }
-    
-    # Save updated responses
-    save_persistent_data()
+    })
     
     # Create mention tags for global admins
     admin_mentions = ""
@@ -938,7 +1144,7 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
         return
     
     # Check if this is a reply and contains "同意" or "确认"
-    if not update.message.reply_to_message or not any(word in update.message.text for word in ["同意", "确认"]):
+    if not update.message.reply_to_message or intents.APPROVE not in message_intent(update, context).keywords:
         return
     
     logger.info(f"Global admin {user_id} approval attempt detected")
@@ -948,15 +1154,14 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
     if update.effective_chat.type == "private":
         logger.info("Approval in private chat detected, finding most recent pending custom amount")
         
-        if not pending_custom_amounts:
+        # Find the most recent pending custom amount
+        newest = pending_custom_amounts.newest()
+        if not newest:
             logger.info("No pending custom amounts found")
             update.message.reply_text("没有待审批的自定义金额。")
             return
         
-        # Find the most recent pending custom amount
-        most_recent_msg_id = max(pending_custom_amounts.keys())
-        approval_data = pending_custom_amounts[most_recent_msg_id]
-        
+        most_recent_msg_id, approval_data = newest
         logger.info(f"Found most recent pending custom amount: {approval_data}")
         
         # Process the approval
@@ -967,37 +1172,22 @@ def handle_custom_amount_approval(update: Update, context: CallbackContext) -> N
     reply_msg_id = update.message.reply_to_message.message_id
     logger.info(f"Checking if message {reply_msg_id} has a pending approval")
     
-    # Debug all pending custom amounts to check what's stored
-    logger.info(f"All pending custom amounts: {pending_custom_amounts}")
-    
-    # First, check if the message being replied to is directly in pending_custom_amounts
-    if reply_msg_id in pending_custom_amounts:
-        logger.info(f"Found direct match for message {reply_msg_id}")
-        approval_data = pending_custom_amounts[reply_msg_id]
-        process_custom_amount_approval(update, context, reply_msg_id, approval_data)
+    # Look the message up directly, then through the original/replied-to message ID indexes
+    match = pending_custom_amounts.find_by_message(reply_msg_id)
+    if match:
+        msg_id, approval_data = match
+        logger.info(f"Found pending approval {msg_id} for message {reply_msg_id}")
+        process_custom_amount_approval(update, context, msg_id, approval_data)
         return
     
-    # If not, search through all pending approvals
-    for msg_id, data in pending_custom_amounts.items():
-        logger.info(f"Checking pending approval {msg_id} with data {data}")
-        
-        # Check if any of the stored message IDs match
-        if (data.get('original_msg_id') == reply_msg_id or 
-            str(data.get('original_msg_id')) == str(reply_msg_id) or
-            data.get('reply_to_msg_id') == reply_msg_id or
-            str(data.get('reply_to_msg_id')) == str(reply_msg_id)):
-            
-            logger.info(f"Found matching pending approval through message ID comparison: {msg_id}")
-            process_custom_amount_approval(update, context, msg_id, data)
-            return
-    
-    # If we still can't find it, try checking the message content
+    # If we still can't find it, look up the amounts mentioned in the replied-to message
     reply_message_text = update.message.reply_to_message.text if update.message.reply_to_message.text else ""
-    for msg_id, data in pending_custom_amounts.items():
-        custom_amount = data.get('amount')
-        if f"+{custom_amount}" in reply_message_text:
+    for custom_amount in re.findall(r'\+(\d+)', reply_message_text):
+        match = pending_custom_amounts.find_by_amount(custom_amount)
+        if match:
+            msg_id, approval_data = match
             logger.info(f"Found matching pending approval through message content: {msg_id}")
-            process_custom_amount_approval(update, context, msg_id, data)
+            process_custom_amount_approval(update, context, msg_id, approval_data)
             return
     
     logger.info(f"No pending approval found for message ID: {reply_msg_id}")
@@ -1016,20 +1206,17 @@ def process_custom_amount_approval(update, context, msg_id, approval_data):
     logger.info(f"Full approval data: {approval_data}")
     
     # Get the corresponding forwarded message data
-    if img_id in forwarded_msgs:
-        msg_data = forwarded_msgs[img_id]
+    msg_data = find_forwarded_msg(img_id)
+    if msg_data is not None:
         logger.info(f"Found forwarded message data: {msg_data}")
         
         # Process the custom amount like a regular response
         response_text = f"+{custom_amount}"
         
         # Save the response
-        group_b_responses[img_id] = response_text
+        store_group_b_response(img_id, response_text)
         logger.info(f"Stored custom amount response: {response_text}")
         
-        # Save responses
-        save_persistent_data()
-        
         # Mark the image as open
         db.set_image_status(img_id, "open")
         logger.info(f"Set image {img_id} status to open after custom amount approval")
@@ -1091,10 +1278,8 @@ def process_custom_amount_approval(update, context, msg_id, approval_data):
         # No longer sending "自定义金额 X 已批准，并已发送到群A"
         
         # Delete the pending approval
-        if msg_id in pending_custom_amounts:
-            del pending_custom_amounts[msg_id]
+        if remove_pending_custom_amount(msg_id):
             logger.info(f"Deleted pending approval with ID {msg_id}")
-            save_persistent_data()
         else:
             logger.warning(f"Tried to delete non-existent pending approval with ID {msg_id}")
         
@@ -1133,7 +1318,6 @@ def handle_group_b_reset_images(update: Update, context: CallbackContext) -> Non
     """Handle the command to reset all images in Group B."""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    message_text = update.message.text.strip()
     
     # Check if this is Group B
     if chat_id not in GROUP_B_IDS and chat_id != GROUP_B_ID:
@@ -1141,7 +1325,7 @@ def handle_group_b_reset_images(update: Update, context: CallbackContext) -> Non
         return
     
     # Check if the message is exactly "重置群码"
-    if message_text != "重置群码":
+    if message_intent(update, context).kind != intents.RESET_ALL:
         return
     
     # Check if user is a group admin or global admin
@@ -1152,99 +1336,60 @@ def handle_group_b_reset_images(update: Update, context: CallbackContext) -> Non
     
     logger.info(f"Admin {user_id} is resetting images in Group B: {chat_id}")
     
-    # Get current image count for this specific Group B for reporting
-    all_images = db.get_all_images()
-    logger.info(f"Total images in database before reset: {len(all_images)}")
-    
-    # Count images associated with this Group B
-    group_b_images = []
-    if all_images:
-        for img in all_images:
-            metadata = img.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                except:
-                    metadata = {}
-                    
-            if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                try:
-                    if int(metadata['source_group_b_id']) == int(chat_id):
-                        group_b_images.append(img)
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Error comparing Group B IDs: {e}")
-    
-    image_count = len(group_b_images)
-    logger.info(f"Found {image_count} images associated with Group B {chat_id}")
-    
-    # Backup the existing images before deleting
-    # Backup functionality removed
-    
-    # Delete only images from this Group B
+    # Delete this Group B's images and their message mappings in one pass
     try:
-        # Use our new function to delete only images from this Group B
-        success = db.clear_images_by_group_b(chat_id)
-        
-        # Also clear related message mappings for this Group B
-        global forwarded_msgs, group_b_responses
-        
-        # Filter out messages related to this Group B
-        if forwarded_msgs:
-            # Create a new dict to avoid changing size during iteration
-            new_forwarded_msgs = {}
-            for msg_id, data in forwarded_msgs.items():
-                # If the message was sent to this Group B, remove it
-                if 'group_b_chat_id' in data and int(data['group_b_chat_id']) != int(chat_id):
-                    new_forwarded_msgs[msg_id] = data
-                else:
-                    logger.info(f"Removing forwarded message mapping for {msg_id}")
-            
-            forwarded_msgs = new_forwarded_msgs
-        
-        # Same for group_b_responses
-        if group_b_responses:
-            new_group_b_responses = {}
-            for msg_id, data in group_b_responses.items():
-                if 'chat_id' in data and int(data['chat_id']) != int(chat_id):
-                    new_group_b_responses[msg_id] = data
-            group_b_responses = new_group_b_responses
-        
-        save_persistent_data()
-        
-        # Check if all images for this Group B were actually deleted
-        remaining_images = db.get_all_images()
-        remaining_for_group_b = []
-        
-        for img in remaining_images:
-            metadata = img.get('metadata', {})
-            if isinstance(metadata, str):
-                try:
-                    metadata = json.loads(metadata)
-                except:
-                    metadata = {}
-                    
-            if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                try:
-                    if int(metadata['source_group_b_id']) == int(chat_id):
-                        remaining_for_group_b.append(img)
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Error comparing Group B IDs: {e}")
+        removed = {}
+        deleted = db.reset_group_b_images(
+            chat_id,
+            on_delete=lambda conn, image_ids: removed.update(drop_image_mappings(conn, image_ids, chat_id))
+        )
         
-        if success:
-            if not remaining_for_group_b:
-                logger.info(f"Successfully cleared {image_count} images for Group B: {chat_id}")
-                update.message.reply_text(f"🔄 已重置所有群码! 共清除了 {image_count} 个图片。")
-            else:
-                # Some images still exist for this Group B
-                logger.warning(f"Reset didn't clear all images. {len(remaining_for_group_b)} images still remain for Group B {chat_id}")
-                update.message.reply_text(f"⚠️ 群码重置部分完成。已清除 {image_count - len(remaining_for_group_b)} 个图片，但还有 {len(remaining_for_group_b)} 个图片未能清除。")
-        else:
+        if deleted is None:
+            restore_image_mappings(removed)
             logger.error(f"Failed to clear images for Group B: {chat_id}")
             update.message.reply_text("重置群码时出错，请查看日志。")
+            return
+        
+        logger.info(f"Successfully cleared {deleted} images and {len(removed['forwarded_msgs'])} message mappings for Group B: {chat_id}")
+        update.message.reply_text(f"🔄 已重置所有群码! 共清除了 {deleted} 个图片。")
     except Exception as e:
         logger.error(f"Error clearing images: {e}")
         update.message.reply_text(f"重置群码时出错: {e}")
 
+def drop_image_mappings(conn, image_ids: List[str], group_b_chat_id: int, number: Optional[int] = None) -> Dict:
+    """Remove the forwarded_msgs/group_b_responses entries of deleted images (and any other
+    mapping for the same Group B, and number if given) within the reset transaction on conn,
+    returning what was removed."""
+    if number is None:
+        removed_msgs = forwarded_msgs.remove_group_b_chat(group_b_chat_id)
+    else:
+        removed_msgs = forwarded_msgs.remove_keys(forwarded_msgs.keys_for_number(group_b_chat_id, number))
+    removed_msgs.update(forwarded_msgs.remove_keys(image_ids))
+    deleted_ids = set(image_ids) | set(removed_msgs)
+    
+    removed = {'forwarded_msgs': removed_msgs, 'group_b_responses': {}}
+    logger.info(f"Removing {len(removed['forwarded_msgs'])} forwarded message mappings for Group B {group_b_chat_id}")
+    
+    for img_id in deleted_ids:
+        if img_id in group_b_responses:
+            logger.info(f"Removing group B response for {img_id}")
+            removed['group_b_responses'][img_id] = group_b_responses.pop(img_id)
+    
+    if state_journal is not None:
+        for img_id in deleted_ids:
+            state_journal.delete('forwarded_msgs', img_id)
+            state_journal.delete('group_b_responses', img_id)
+    else:
+        db.delete_image_message_state(list(deleted_ids), conn)
+    return removed
+
+def restore_image_mappings(removed: Dict) -> None:
+    """Put back mappings removed by drop_image_mappings when the image delete was rolled back."""
+    for img_id, data in removed.get('forwarded_msgs', {}).items():
+        store_forwarded_msg(img_id, data)
+    for img_id, response_text in removed.get('group_b_responses', {}).items():
+        store_group_b_response(img_id, response_text)
+
 def set_image_group_b(update: Update, context: CallbackContext) -> None:
     """Set which Group B an image should be associated with."""
     user_id = update.effective_user.id
@@ -1298,16 +1443,10 @@ def debug_metadata(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("Only global admins can use this command.")
         return
     
-    # Get all images
-    images = db.get_all_images()
-    if not images:
-        update.message.reply_text("No images available.")
-        return
-    
     # Format the metadata for each image
     message_parts = ["📋 Image Metadata Debug:"]
     
-    for img in images:
+    for img in db.iter_images():
         image_id = img['image_id']
         status = img['status']
         number = img['number']
@@ -1330,6 +1469,10 @@ def debug_metadata(update: Update, context: CallbackContext) -> None:
         message_parts.append(f"🔸 Target Group B: {target_group_b}")
         message_parts.append("")  # Empty line for spacing
     
+    if len(message_parts) == 1:
+        update.message.reply_text("No images available.")
+        return
+    
     # Send the debug info
     message = "\n".join(message_parts)
     
@@ -1342,6 +1485,54 @@ def debug_metadata(update: Update, context: CallbackContext) -> None:
     else:
         update.message.reply_text(message)
 
+def db_stats_command(update: Update, context: CallbackContext) -> None:
+    """Show database connection pool statistics."""
+    user_id = update.effective_user.id
+    
+    # Only allow global admins
+    if not is_global_admin(user_id):
+        update.message.reply_text("Only global admins can use this command.")
+        return
+    
+    stats = db.get_pool_stats()
+    cache_stats = db.get_cache_stats()
+    message = (
+        "🗄 Database Connection Stats:\n\n"
+        f"Open connections: {stats['open_connections']}\n"
+        f"Connections opened: {stats['connections_opened']}\n"
+        f"Connections reused: {stats['connections_reused']}\n"
+        f"Connections reclaimed from exited threads: {stats['connections_reclaimed']}\n"
+        f"Connections closed: {stats['connections_closed']}\n"
+        f"Leaked transactions: {stats['leaked_transactions']}\n\n"
+        "🧠 Image Cache Stats:\n\n"
+        f"Cached images: {cache_stats['size']}/{cache_stats['max_size']}\n"
+        f"Hits: {cache_stats['hits']} | Misses: {cache_stats['misses']} ({cache_stats['hit_rate']:.1%} hit rate)\n"
+        f"Evictions: {cache_stats['evictions']}"
+    )
+    update.message.reply_text(message)
+
+def inventory_command(update: Update, context: CallbackContext) -> None:
+    """Show open/closed image counts overall and per Group B."""
+    user_id = update.effective_user.id
+    
+    # Only allow global admins
+    if not is_global_admin(user_id):
+        update.message.reply_text("Only global admins can use this command.")
+        return
+    
+    snapshot = db.inventory_snapshot()
+    lines = [
+        "📦 Image Inventory:",
+        "",
+        f"Total: {snapshot['total']} | Open: {snapshot['open']} | Closed: {snapshot['closed']}",
+        ""
+    ]
+    for group_b_id, counts in sorted(snapshot['by_group_b'].items(), key=lambda item: item[0] or 0):
+        name = f"Group B {group_b_id}" if group_b_id is not None else "Ungrouped"
+        lines.append(f"🔸 {name}: {counts['total']} (open {counts['open']}, closed {counts['closed']})")
+    
+    update.message.reply_text("\n".join(lines))
+
 # Add a global variable to store the dispatcher
 dispatcher = None
 
@@ -1353,6 +1544,70 @@ def error_handler(update, context):
     if isinstance(context.error, (NetworkError, TimedOut, RetryAfter)):
         logger.error(f"Network error: {context.error}")
 
+class SetGroupPhotoFilter(MessageFilter):
+    """Matches "设置群 N" photos and every album photo, handing the caption's intent to the handler.
+    
+    Telegram may put an album's caption on any of its photos and deliver them in any order, so
+    album photos are all queued; flush_image_batch keeps those whose album had a 设置群 caption
+    and silently drops the rest.
+    """
+    data_filter = True
+    
+    def filter(self, message):
+        intent = intents.classify_caption(message.caption or "")
+        if intent.kind == intents.SET_GROUP_IMAGE:
+            return {'intents': [intent]}
+        if message.media_group_id is not None:
+            return {'intents': [intents.Intent(intents.SET_GROUP_IMAGE)]}
+        return False
+
+set_group_photo_filter = SetGroupPhotoFilter()
+
+class ChatMembershipFilter(MessageFilter):
+    """Matches messages from the legacy chat or any chat in a live set of chat IDs.
+    
+    The set is looked up on every message, so adding or removing a group (or reloading the
+    configuration) takes effect immediately without re-registering handlers.
+    """
+    def __init__(self, chat_ids: Callable[[], set], legacy_chat_id: int):
+        self.chat_ids = chat_ids
+        self.legacy_chat_id = legacy_chat_id
+    
+    def filter(self, message):
+        return message.chat_id == self.legacy_chat_id or message.chat_id in self.chat_ids()
+
+group_a_chat_filter = ChatMembershipFilter(lambda: GROUP_A_IDS, GROUP_A_ID)
+group_b_chat_filter = ChatMembershipFilter(lambda: GROUP_B_IDS, GROUP_B_ID)
+
+class IntentFilter(MessageFilter):
+    """Matches text messages whose intent is one of kinds, handing it to the handler as context.intents.
+    
+    Every IntentFilter shares the classification of the message being dispatched, so a message
+    is classified once however many handlers look at it.
+    """
+    data_filter = True
+    _last = (None, intents.NO_INTENT)  # Format: ((chat_id, message_id, text), intent)
+    
+    def __init__(self, *kinds: str):
+        self.kinds = kinds
+    
+    def filter(self, message):
+        key = (message.chat_id, message.message_id, message.text)
+        last_key, intent = IntentFilter._last
+        if key != last_key:
+            intent = intents.classify((message.text or "").strip())
+            IntentFilter._last = (key, intent)
+        return {'intents': [intent]} if intent.kind in self.kinds else False
+
+def message_intent(update: Update, context: CallbackContext, caption: bool = False) -> intents.Intent:
+    """The intent a data filter classified this message as, classifying it here if none did."""
+    found = getattr(context, 'intents', None)
+    if found:
+        return found[0]
+    if caption:
+        return intents.classify_caption(update.message.caption or "")
+    return intents.classify((update.message.text or "").strip())
+
 def register_handlers(dispatcher):
     """Register all message handlers."""
     # Clear existing handlers first
@@ -1364,29 +1619,37 @@ def register_handlers(dispatcher):
     dispatcher.add_handler(CommandHandler("help", help_command))
     dispatcher.add_handler(CommandHandler("setimage", set_image))
     dispatcher.add_handler(CommandHandler("images", list_images))
+    dispatcher.add_handler(CommandHandler("dbstats", db_stats_command))
+    dispatcher.add_handler(CommandHandler("inventory", inventory_command))
+    dispatcher.add_handler(CommandHandler("groupbshare", handle_group_b_share_report))
     
     # Add button callback handler (highest priority)
     dispatcher.add_handler(CallbackQueryHandler(button_callback))
     
     # Add handler for "设置点击模式" command
     dispatcher.add_handler(MessageHandler(
-        Filters.text & Filters.regex(r'^设置点击模式$') & (Filters.chat(GROUP_B_ID) | Filters.chat(list(GROUP_B_IDS))),
+        Filters.text & group_b_chat_filter & IntentFilter(intents.SET_CLICK_MODE),
         handle_set_click_mode,
         run_async=True
     ))
     
-    # Handle Group A messages
+    # Handle "设置群 N" photo uploads (and the uncaptioned rest of their albums) in Group B
+    dispatcher.add_handler(MessageHandler(
+        Filters.photo & group_b_chat_filter & set_group_photo_filter,
+        handle_set_group_image,
+        run_async=True
+    ))
+    
+    # Handle Group A amount messages ("+N" replies never classify as amounts)
     dispatcher.add_handler(MessageHandler(
-        Filters.text & 
-        ~Filters.regex(r'^\+') &  # Exclude messages starting with +
-        ((Filters.chat(GROUP_A_ID) | Filters.chat(list(GROUP_A_IDS)))),  # Any message in Group A
+        Filters.text & group_a_chat_filter & IntentFilter(intents.AMOUNT),
         handle_group_a_message,
         run_async=True
     ))
     
-    # Handle Group B messages
+    # Handle Group B amount messages
     dispatcher.add_handler(MessageHandler(
-        Filters.text & (Filters.chat(GROUP_B_ID) | Filters.chat(list(GROUP_B_IDS))),
+        Filters.text & group_b_chat_filter & IntentFilter(intents.AMOUNT),
         handle_all_group_b_messages,
         run_async=True
     ))
@@ -1401,9 +1664,11 @@ def main() -> None:
         logger.error("No token provided. Set TELEGRAM_BOT_TOKEN environment variable.")
         return
     
+    # Bring the image database schema up to date before any handler touches it
+    db.init_db()
+    
     # Load persistent data
-    load_persistent_data()
-    load_config_data()  # Make sure to load configuration data as well
+    load_persistent_data()  # Also loads the configuration
     
     # Create the Updater
     updater = Updater(TOKEN)
@@ -1413,14 +1678,24 @@ def main() -> None:
     
     # Register all handlers
     register_handlers(dispatcher)
+    start_config_watcher()
     
     # Start the Bot
     updater.start_polling()
     updater.idle()
+    
+    # updater.idle() returns on SIGTERM/SIGINT after stopping polling and joining the handler
+    # threads; write out anything still pending, then release every database connection
+    config_watcher_stop.set()
+    if config_watcher_thread is not None:
+        config_watcher_thread.join(timeout=5)
+    config_writer.close()
+    if state_journal is not None:
+        state_journal.close()
+    db.close_connections(all_threads=True)
 
 def handle_dissolve_group(update: Update, context: CallbackContext) -> None:
     """Handle clearing settings for the current group only."""
-    global dispatcher
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
@@ -1440,19 +1715,16 @@ def handle_dissolve_group(update: Update, context: CallbackContext) -> None:
         return
     
     # Remove only this specific chat from the appropriate group
-    if in_group_a:
-        GROUP_A_IDS.discard(int(chat_id))
-        group_type = "供方群 (Group A)"
-    elif in_group_b:
-        GROUP_B_IDS.discard(int(chat_id))
-        group_type = "需方群 (Group B)"
-    
-    # Save the configuration
-    save_config_data()
-    
-    # Reload handlers to reflect changes
-    if dispatcher:
-        register_handlers(dispatcher)
+    with config_lock:
+        if in_group_a:
+            GROUP_A_IDS.discard(int(chat_id))
+            group_type = "供方群 (Group A)"
+        elif in_group_b:
+            GROUP_B_IDS.discard(int(chat_id))
+            group_type = "需方群 (Group B)"
+        
+        # Save the configuration
+        save_config_data('group_a_ids', 'group_b_ids')
     
     logger.info(f"Group {chat_id} removed from {group_type} by user {user_id}")
     update.message.reply_text(f"✅ 此群聊已从{group_type}中移除。其他群聊不受影响。")
@@ -1469,23 +1741,22 @@ def handle_toggle_forwarding(update: Update, context: CallbackContext) -> None:
         update.message.reply_text("只有全局管理员可以切换转发状态。")
         return
     
-    # Get command text
-    text = update.message.text.strip().lower()
-    
-    # Determine whether to open or close forwarding
-    if "开启转发" in text:
-        FORWARDING_ENABLED = True
-        status_message = "✅ 群转发功能已开启 - 消息将从群B转发到群A"
-    elif "关闭转发" in text:
-        FORWARDING_ENABLED = False
-        status_message = "🚫 群转发功能已关闭 - 消息将不会从群B转发到群A"
-    else:
-        # Toggle current state if just "转发状态"
-        FORWARDING_ENABLED = not FORWARDING_ENABLED
-        status_message = "✅ 群转发功能已开启" if FORWARDING_ENABLED else "🚫 群转发功能已关闭"
-    
-    # Save configuration
-    save_config_data()
+    # Determine whether to open or close forwarding; either keyword counts anywhere in the text
+    keywords = message_intent(update, context).keywords
+    with config_lock:
+        if intents.FORWARDING_ON in keywords:
+            FORWARDING_ENABLED = True
+            status_message = "✅ 群转发功能已开启 - 消息将从群B转发到群A"
+        elif intents.FORWARDING_OFF in keywords:
+            FORWARDING_ENABLED = False
+            status_message = "🚫 群转发功能已关闭 - 消息将不会从群B转发到群A"
+        else:
+            # Toggle current state if just "转发状态"
+            FORWARDING_ENABLED = not FORWARDING_ENABLED
+            status_message = "✅ 群转发功能已开启" if FORWARDING_ENABLED else "🚫 群转发功能已关闭"
+        
+        # Save configuration
+        save_config_data('forwarding_enabled')
     
     logger.info(f"Forwarding status set to {FORWARDING_ENABLED} by user {user_id} in {chat_type} chat")
     update.message.reply_text(status_message)
@@ -1510,8 +1781,7 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
     number = number_match.group(1) if number_match else None
     
     # Check if we have images in database
-    images = db.get_all_images()
-    if not images:
+    if not db.has_images():
         logger.info("No images found in database")
         update.message.reply_text("没有可用的图片。")
         return
@@ -1520,11 +1790,9 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
     image = None
     if number:
         # Try to find image with matching number
-        for img in images:
-            if str(img.get('number')) == number:
-                image = img
-                logger.info(f"Found image with number {number}: {img['image_id']}")
-                break
+        image = next(db.iter_images(number=int(number), batch_size=1), None)
+        if image:
+            logger.info(f"Found image with number {number}: {image['image_id']}")
         
         # If no match found, inform admin
         if not image:
@@ -1536,7 +1804,12 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
         image = db.get_random_open_image()
         if not image:
             # If no open images, just get any image
-            image = images[0]
+            image = next(db.iter_images(batch_size=1), None)
+            if not image:
+                # Deleted since the has_images() check
+                logger.info("No images found in database")
+                update.message.reply_text("没有可用的图片。")
+                return
             logger.info(f"No open images, using first available: {image['image_id']}")
         else:
             logger.info(f"Using random open image: {image['image_id']}")
@@ -1576,7 +1849,7 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
                 )
                 
                 # Store mapping for responses
-                forwarded_msgs[image['image_id']] = {
+                store_forwarded_msg(image['image_id'], {
                     'group_a_msg_id': sent_msg.message_id,
                     'group_a_chat_id': chat_id,
                     'group_b_msg_id': forwarded.message_id,
@@ -1586,9 +1859,7 @@ def handle_admin_send_image(update: Update, context: CallbackContext) -> None:
                     'number': str(image['number']),
                     'original_user_id': user_id,
                     'original_message_id': update.message.message_id
-                }
-                
-                save_persistent_data()
+                })
                 logger.info(f"Admin forwarded image {image['image_id']} to Group B {target_group_b}")
                 
                 # Only set image to closed if explicitly requested to avoid confusion
@@ -1605,7 +1876,6 @@ def handle_reset_specific_image(update: Update, context: CallbackContext) -> Non
     """Handle command to reset a specific image by its number."""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    message_text = update.message.text.strip()
     
     # Check if this is Group B
     if chat_id not in GROUP_B_IDS and chat_id != GROUP_B_ID:
@@ -1613,11 +1883,11 @@ def handle_reset_specific_image(update: Update, context: CallbackContext) -> Non
         return
     
     # Extract the image number from the command "重置群{number}"
-    match = re.search(r'^重置群(\d+)$', message_text)
-    if not match:
+    intent = message_intent(update, context)
+    if intent.kind != intents.RESET_NUMBER:
         return
     
-    image_number = int(match.group(1))
+    image_number = intent.value
     logger.info(f"Reset command for image number {image_number} detected in Group B {chat_id}")
     
     # Check if user is a group admin or global admin
@@ -1628,51 +1898,26 @@ def handle_reset_specific_image(update: Update, context: CallbackContext) -> Non
     
     logger.info(f"Admin {user_id} is resetting image number {image_number} in Group B: {chat_id}")
     
-    # Get image count before deletion
-    all_images = db.get_all_images()
-    before_count = len(all_images)
-    logger.info(f"Total images in database before reset: {before_count}")
+    # Delete the images with this number and their message mappings in one pass
+    removed = {}
+    deleted = db.reset_number_images(
+        chat_id, image_number,
+        on_delete=lambda conn, image_ids: removed.update(drop_image_mappings(conn, image_ids, chat_id, image_number))
+    )
     
-    # Delete the specific image by its number
-    success = db.delete_image_by_number(image_number, chat_id)
-    
-    if success:
-        # Also clear related message mappings for this image
-        global forwarded_msgs, group_b_responses
-        
-        # Find any message mappings related to this image
-        mappings_to_remove = []
-        for img_id, data in forwarded_msgs.items():
-            if data.get('number') == str(image_number) and data.get('group_b_chat_id') == chat_id:
-                mappings_to_remove.append(img_id)
-                logger.info(f"Found matching mapping for image {img_id} with number {image_number}")
-        
-        # Remove the found mappings
-        for img_id in mappings_to_remove:
-            if img_id in forwarded_msgs:
-                logger.info(f"Removing forwarded message mapping for {img_id}")
-                del forwarded_msgs[img_id]
-            if img_id in group_b_responses:
-                logger.info(f"Removing group B response for {img_id}")
-                del group_b_responses[img_id]
-        
-        save_persistent_data()
-        
-        # Get image count after deletion
-        remaining_images = db.get_all_images()
-        after_count = len(remaining_images)
-        deleted_count = before_count - after_count
-        
-        # Provide feedback to the user
-        if deleted_count > 0:
-            update.message.reply_text(f"✅ 已重置群码 {image_number}，删除了 {deleted_count} 张图片。")
-            logger.info(f"Successfully reset image number {image_number}")
-        else:
-            update.message.reply_text(f"⚠️ 未找到群号为 {image_number} 的图片，或者删除操作失败。")
-            logger.warning(f"No images with number {image_number} were deleted")
-    else:
+    if deleted is None:
+        restore_image_mappings(removed)
         update.message.reply_text(f"❌ 重置群码 {image_number} 失败。未找到匹配的图片。")
         logger.error(f"Failed to reset image number {image_number}")
+        return
+    
+    # Provide feedback to the user
+    if deleted > 0:
+        update.message.reply_text(f"✅ 已重置群码 {image_number}，删除了 {deleted} 张图片。")
+        logger.info(f"Successfully reset image number {image_number}")
+    else:
+        update.message.reply_text(f"⚠️ 未找到群号为 {image_number} 的图片，或者删除操作失败。")
+        logger.warning(f"No images with number {image_number} were deleted")
 
 def fix_group_type(update: Update, context: CallbackContext) -> None:
     """Fix group type command for global admins only."""
@@ -1691,21 +1936,19 @@ def fix_group_type(update: Update, context: CallbackContext) -> None:
         group_id = int(args[0])
         new_type = args[1].lower()
         
-        if new_type == 'a':
-            if group_id in GROUP_B_IDS:
-                GROUP_B_IDS.remove(group_id)
-            GROUP_A_IDS.add(group_id)
-            update.message.reply_text(f"✅ Group {group_id} moved to Group A")
-        elif new_type == 'b':
-            if group_id in GROUP_A_IDS:
-                GROUP_A_IDS.remove(group_id)
-            GROUP_B_IDS.add(group_id)
-            update.message.reply_text(f"✅ Group {group_id} moved to Group B")
-        else:
+        if new_type not in ('a', 'b'):
             update.message.reply_text("❌ Type must be 'a' or 'b'")
             return
         
-        save_config_data()
+        with config_lock:
+            if new_type == 'a':
+                GROUP_B_IDS.discard(group_id)
+                GROUP_A_IDS.add(group_id)
+            else:
+                GROUP_A_IDS.discard(group_id)
+                GROUP_B_IDS.add(group_id)
+            save_config_data('group_a_ids', 'group_b_ids')
+        update.message.reply_text(f"✅ Group {group_id} moved to Group {new_type.upper()}")
         
     except ValueError:
         update.message.reply_text("❌ Invalid group ID format")
@@ -1739,8 +1982,9 @@ def handle_set_group_b_percentage(update: Update, context: CallbackContext) -> N
             update.message.reply_text(f"⚠️ Group ID {group_b_id} is not a registered Group B")
             return
         
-        group_b_percentages[group_b_id] = percentage
-        save_config_data()
+        with config_lock:
+            group_b_percentages[group_b_id] = percentage
+            save_config_data('group_b_percentages')
         
         update.message.reply_text(f"✅ Set Group B {group_b_id} to {percentage}% chance for image distribution")
         logger.info(f"Global admin {user_id} set Group B {group_b_id} to {percentage}%")
@@ -1761,8 +2005,9 @@ def handle_reset_group_b_percentages(update: Update, context: CallbackContext) -
     
     try:
         global group_b_percentages
-        group_b_percentages.clear()
-        save_config_data()
+        with config_lock:
+            group_b_percentages.clear()
+            save_config_data('group_b_percentages')
         
         update.message.reply_text("✅ All Group B percentages have been reset. Image distribution is back to normal.")
         logger.info(f"Global admin {user_id} reset all Group B percentages")
@@ -1795,6 +2040,33 @@ def handle_list_group_b_percentages(update: Update, context: CallbackContext) ->
         logger.error(f"Error in handle_list_group_b_percentages: {e}")
         update.message.reply_text("❌ Error listing Group B percentages")
 
+def handle_group_b_share_report(update: Update, context: CallbackContext) -> None:
+    """Report configured vs realised image share for each Group B."""
+    user_id = update.message.from_user.id
+    
+    if not is_global_admin(user_id):
+        update.message.reply_text("⚠️ Only global admins can use this command.")
+        return
+    
+    try:
+        report = db.get_share_report(GROUP_B_IDS, group_b_percentages)
+        if not report:
+            update.message.reply_text("📊 No Group B distribution data yet.")
+            return
+        
+        message = "📊 Group B Share (configured / realised):\n\n"
+        for entry in report:
+            name = f"Group B {entry['group_b_id']}" if entry['group_b_id'] is not None else "Ungrouped images"
+            message += (
+                f"{name}: {entry['configured_share']:.1%} / {entry['realised_share']:.1%} "
+                f"({entry['served']} served)\n"
+            )
+        update.message.reply_text(message)
+        
+    except Exception as e:
+        logger.error(f"Error in handle_group_b_share_report: {e}")
+        update.message.reply_text("❌ Error building Group B share report")
+
 # Click mode management functions
 def is_click_mode_enabled(group_b_id):
     """Check if click mode is enabled for a specific Group B."""
@@ -1802,8 +2074,9 @@ def is_click_mode_enabled(group_b_id):
 
 def set_click_mode(group_b_id, enabled):
     """Set click mode for a specific Group B."""
-    group_b_click_mode[int(group_b_id)] = enabled
-    save_config_data()
+    with config_lock:
+        group_b_click_mode[int(group_b_id)] = enabled
+        save_config_data('group_b_click_mode')
     logger.info(f"Set click mode for Group B {group_b_id} to {enabled}")
 
 # Message deletion scheduling functions
@@ -1892,52 +2165,22 @@ def handle_all_group_b_messages(update: Update, context: CallbackContext) -> Non
         logger.info("Message starts with '+', skipping")
         return
     
-    # Match any of the formats:
-    # - Just a number
-    # - number+群 or number 群
-    # - 群+number or 群 number
-    # - 微信+number or 微信 number 
-    # - number+微信 or number 微信
-    # - 微信群+number or 微信群 number
-    # - number+微信群 or number 微信群
-    patterns = [
-        r'^(\d+)$',  # Just a number
-        r'^(\d+)\s*群$',  # number+群
-        r'^群\s*(\d+)$',  # 群+number
-        r'^微信\s*(\d+)$',  # 微信+number
-        r'^(\d+)\s*微信$',  # number+微信
-        r'^微信群\s*(\d+)$',  # 微信群+number
-        r'^(\d+)\s*微信群$',  # number+微信群
-        r'^微信\s*群\s*(\d+)$',  # 微信 群 number (with spaces)
-        r'^(\d+)\s*微信\s*群$'   # number 微信 群 (with spaces)
-    ]
-    
-    amount = None
-    for pattern in patterns:
-        match = re.search(pattern, text)
-        if match:
-            amount = match.group(1)
-            logger.info(f"Matched pattern '{pattern}' with amount: {amount}")
-            break
-    
-    if not amount:
+    # Classified once by the handler's IntentFilter; only amount messages are handled here
+    intent = message_intent(update, context)
+    if intent.kind != intents.AMOUNT:
         logger.info("Message doesn't match any accepted format")
         return
+    amount = intent.value
+    logger.info(f"Matched amount: {amount}")
     
     # Check if the number is between 20 and 5000 (inclusive)
-    try:
-        amount_int = int(amount)
-        if amount_int < 20 or amount_int > 5000:
-            logger.info(f"Number {amount} is outside the allowed range (20-5000).")
-            return
-    except ValueError:
-        logger.info(f"Invalid number format: {amount}")
+    if amount < 20 or amount > 5000:
+        logger.info(f"Number {amount} is outside the allowed range (20-5000).")
         return
     
     # Rest of the function remains unchanged
     # Check if we have any images
-    images = db.get_all_images()
-    if not images:
+    if not db.has_images():
         logger.info("No images found in database - remaining silent")
         return
     
@@ -1958,11 +2201,7 @@ def button_callback(update: Update, context: CallbackContext) -> None:
         image_id = data[8:]  # Remove 'release_' prefix
         
         # Find the message data
-        msg_data = None
-        for img_id, data in forwarded_msgs.items():
-            if img_id == image_id:
-                msg_data = data
-                break
+        image_id, msg_data = find_forwarded_msg_for_button(query, image_id)
         
         if msg_data:
             original_amount = msg_data.get('amount', '0')
@@ -1971,12 +2210,9 @@ def button_callback(update: Update, context: CallbackContext) -> None:
             response_text = f"+{original_amount}"
             
             # Store the response for Group A
-            group_b_responses[image_id] = response_text
+            store_group_b_response(image_id, response_text)
             logger.info(f"Stored Group B release response for image {image_id}: {response_text}")
             
-            # Save updated responses
-            save_persistent_data()
-            
             try:
                 # Set status to open
                 if db.set_image_status(image_id, "open"):
@@ -2017,29 +2253,21 @@ def button_callback(update: Update, context: CallbackContext) -> None:
         query.answer("状态已解除", show_alert=False)
     
     elif data.startswith('verify_'):
-        # Format: verify_image_id_amount
-        parts = data.split('_')
-        if len(parts) >= 3:
-            image_id = parts[1]
-            amount = parts[2]
+        # Format: verify_image_id_amount (image IDs contain '_' themselves)
+        parts = data[len('verify_'):].rsplit('_', 1)
+        if len(parts) == 2:
+            image_id, amount = parts
             
             # Find the message data
-            msg_data = None
-            for img_id, data in forwarded_msgs.items():
-                if img_id == image_id:
-                    msg_data = data
-                    break
+            image_id, msg_data = find_forwarded_msg_for_button(query, image_id)
             
             # Simplified response format - just +amount or custom message for +0
             response_text = "会员没进群呢哥哥~ 😢" if amount == "0" else f"+{amount}"
             
             # Store the response for Group A
-            group_b_responses[image_id] = response_text
+            store_group_b_response(image_id, response_text)
             logger.info(f"Stored Group B button response for image {image_id}: {response_text}")
             
-            # Save updated responses
-            save_persistent_data()
-            
             try:
                 # Set status to open
                 if db.set_image_status(image_id, "open"):
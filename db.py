@@ -1,9 +1,15 @@
+import copy
 import json
 import os
+from collections import OrderedDict
 from typing import Dict, List, Optional, Tuple
 import random
 import logging
 import sqlite3
+import threading
+import time
+import weakref
+from datetime import datetime
 
 # Configure logging
 logging.basicConfig(
@@ -32,61 +38,1181 @@ def save_db(db: Dict) -> None:
     with open(DB_FILE, "w") as f:
         json.dump(db, f, indent=2)
 
-def init_db():
-    """Initialize the database if it doesn't exist."""
+# Connection settings
+DB_TIMEOUT = 30  # Seconds to wait for a lock held by another connection
+DB_CACHE_SIZE_KB = 8192  # Page cache size per connection
+DB_STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+
+# One connection per thread, opened on first use and reused afterwards
+_thread_local = threading.local()
+_pool_lock = threading.Lock()
+# Each connection remembers its thread weakly, so connections of exited threads can be reclaimed
+_connections: Dict[int, Tuple[sqlite3.Connection, weakref.ref]] = {}  # Format: {id(conn): (conn, thread ref)}
+_initialized_files = set()  # Database files already migrated to SCHEMA_VERSION
+_pool_stats = {
+    'connections_opened': 0,
+    'connections_closed': 0,
+    'connections_reused': 0,
+    'connections_reclaimed': 0,
+    'leaked_transactions': 0
+}
+
+def _open_connection() -> sqlite3.Connection:
+    """Open and configure a new SQLite connection."""
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_TIMEOUT,
+        check_same_thread=False,  # Allows close_connections(all_threads=True) from the main thread
+        cached_statements=DB_STATEMENT_CACHE_SIZE
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """Get the calling thread's database connection, opening it on first use."""
+    conn = getattr(_thread_local, 'conn', None)
+    
+    # Reopen if the connection was closed or the database file was changed since it was opened
+    if conn is not None and (id(conn) not in _connections or getattr(_thread_local, 'db_file', None) != DB_FILE):
+        _close_connection(conn)
+        conn = None
+    
+    if conn is None:
+        # A new thread is a good moment to release the connections of threads that have exited
+        _reclaim_dead_connections()
+        conn = _open_connection()
+        _thread_local.conn = conn
+        _thread_local.db_file = DB_FILE
+        with _pool_lock:
+            _connections[id(conn)] = (conn, weakref.ref(threading.current_thread()))
+            _pool_stats['connections_opened'] += 1
+        logger.info(f"Opened database connection for thread {threading.current_thread().name}")
+    else:
+        with _pool_lock:
+            _pool_stats['connections_reused'] += 1
+        
+        # Either a caller on this thread still has its transaction open (a nested call) or a failed
+        # call left one behind; rolling back here could throw away the caller's work, so only report it
+        if conn.in_transaction:
+            with _pool_lock:
+                _pool_stats['leaked_transactions'] += 1
+            logger.warning(f"Connection reused with an open transaction on thread {threading.current_thread().name}")
+    
+    if DB_FILE not in _initialized_files:
+        migrate_db(conn)
+    
+    return conn
+
+def _close_connection(conn: sqlite3.Connection) -> None:
+    """Close a single pooled connection and drop it from the registry."""
+    with _pool_lock:
+        if _connections.pop(id(conn), None) is not None:
+            _pool_stats['connections_closed'] += 1
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Create images table if it doesn't exist
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS images (
-            image_id TEXT PRIMARY KEY,
-            number INTEGER,
-            file_id TEXT,
-            status TEXT DEFAULT 'open'
-        )
-        ''')
-        
-        conn.commit()
         conn.close()
+    except Exception as e:
+        logger.error(f"Error closing database connection: {e}")
+
+def _reclaim_dead_connections() -> None:
+    """Close the connections of threads that have exited without closing them."""
+    with _pool_lock:
+        dead = [conn for conn, thread_ref in _connections.values()
+                if thread_ref() is None or not thread_ref().is_alive()]
+    for conn in dead:
+        _close_connection(conn)
+    if dead:
+        with _pool_lock:
+            _pool_stats['connections_reclaimed'] += len(dead)
+        logger.info(f"Reclaimed {len(dead)} database connections of exited threads")
+
+def close_thread_connection() -> None:
+    """Close the calling thread's connection, if it has one.
+    
+    Short-lived threads (timers, web request threads) should call this when they finish.
+    """
+    conn = getattr(_thread_local, 'conn', None)
+    _thread_local.conn = None
+    if conn is not None:
+        _close_connection(conn)
+
+def close_connections(all_threads: bool = False) -> None:
+    """Close the calling thread's connection, or every pooled connection with all_threads.
+    
+    all_threads closes connections other threads may still be using, so only pass it on shutdown
+    once every worker thread has stopped.
+    """
+    if not all_threads:
+        close_thread_connection()
+        return
+    with _pool_lock:
+        conns = [conn for conn, _ in _connections.values()]
+    for conn in conns:
+        _close_connection(conn)
+    _thread_local.conn = None
+    logger.info(f"Closed {len(conns)} database connections")
+
+def get_pool_stats() -> Dict:
+    """Get connection pool statistics."""
+    with _pool_lock:
+        stats = dict(_pool_stats)
+        stats['open_connections'] = len(_connections)
+    stats['db_file'] = DB_FILE
+    return stats
+
+# Columns selected for every image read, in the order expected by _row_to_image
+IMAGE_COLUMNS = "image_id, number, file_id, status, metadata"
+
+def _migration_create_images(conn: sqlite3.Connection) -> None:
+    """Schema v1: base images table."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS images (
+        image_id TEXT PRIMARY KEY,
+        number INTEGER,
+        file_id TEXT,
+        status TEXT DEFAULT 'open'
+    )
+    ''')
+
+def _migration_add_metadata(conn: sqlite3.Connection) -> None:
+    """Schema v2: metadata JSON column."""
+    # Databases created before versioning may already have added it on the fly
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(images)").fetchall()]
+    if 'metadata' not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN metadata TEXT")
+
+def _migration_group_columns(conn: sqlite3.Connection) -> None:
+    """Schema v3: indexed source_group_b_id/target_group_a_id columns backfilled from metadata."""
+    columns = [col[1] for col in conn.execute("PRAGMA table_info(images)").fetchall()]
+    if 'source_group_b_id' not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN source_group_b_id INTEGER")
+    if 'target_group_a_id' not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN target_group_a_id INTEGER")
+    
+    # One pass over existing rows to copy the IDs out of the JSON blob
+    updates = []
+    for image_id, metadata in conn.execute("SELECT image_id, metadata FROM images WHERE metadata IS NOT NULL"):
+        source_group_b_id, target_group_a_id = _group_ids_from_metadata(metadata)
+        if source_group_b_id is not None or target_group_a_id is not None:
+            updates.append((source_group_b_id, target_group_a_id, image_id))
+    conn.executemany(
+        "UPDATE images SET source_group_b_id = ?, target_group_a_id = ? WHERE image_id = ?",
+        updates
+    )
+    logger.info(f"Backfilled Group B/Group A columns for {len(updates)} images")
+    
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_images_group_b_status_number "
+        "ON images (source_group_b_id, status, number)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_images_group_a_status_number "
+        "ON images (target_group_a_id, status, number)"
+    )
+
+def _migration_status_number_index(conn: sqlite3.Connection) -> None:
+    """Schema v4: (status, number, image_id) index for ascending keyset scans."""
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_images_status_number "
+        "ON images (status, number, image_id)"
+    )
+
+def _migration_dispatch_state(conn: sqlite3.Connection) -> None:
+    """Schema v5: persisted fair-share dispatcher state per Group B."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS dispatch_state (
+        group_key INTEGER PRIMARY KEY,
+        served INTEGER NOT NULL DEFAULT 0,
+        pass REAL NOT NULL DEFAULT 0
+    )
+    ''')
+
+def _migration_inventory_counters(conn: sqlite3.Connection) -> None:
+    """Schema v6: trigger-maintained image counts per (Group B, status)."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS image_counts (
+        group_key INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (group_key, status)
+    )
+    ''')
+    
+    # Ungrouped images are counted under key 0 (chat IDs are never 0)
+    increment = '''
+        INSERT OR IGNORE INTO image_counts (group_key, status, count)
+            VALUES (COALESCE(NEW.source_group_b_id, 0), COALESCE(NEW.status, 'open'), 0);
+        UPDATE image_counts SET count = count + 1
+            WHERE group_key = COALESCE(NEW.source_group_b_id, 0) AND status = COALESCE(NEW.status, 'open');
+    '''
+    decrement = '''
+        UPDATE image_counts SET count = count - 1
+            WHERE group_key = COALESCE(OLD.source_group_b_id, 0) AND status = COALESCE(OLD.status, 'open');
+    '''
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_images_count_insert AFTER INSERT ON images BEGIN {increment} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS trg_images_count_delete AFTER DELETE ON images BEGIN {decrement} END")
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_images_count_update AFTER UPDATE OF status, source_group_b_id ON images "
+        "WHEN OLD.status IS NOT NEW.status OR OLD.source_group_b_id IS NOT NEW.source_group_b_id "
+        f"BEGIN {decrement} {increment} END"
+    )
+    
+    conn.execute("DELETE FROM image_counts")
+    conn.execute(
+        "INSERT INTO image_counts (group_key, status, count) "
+        "SELECT COALESCE(source_group_b_id, 0), COALESCE(status, 'open'), COUNT(*) FROM images "
+        "GROUP BY COALESCE(source_group_b_id, 0), COALESCE(status, 'open')"
+    )
+
+def _migration_id_sequence(conn: sqlite3.Connection) -> None:
+    """Schema v7: image ID sequence seeded past every existing img_<n> ID."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS id_sequences (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+    )
+    ''')
+    
+    highest = 0
+    for (image_id,) in conn.execute("SELECT image_id FROM images WHERE image_id LIKE 'img\\_%' ESCAPE '\\'"):
+        suffix = image_id[len(IMAGE_ID_PREFIX):]
+        if suffix.isdigit():
+            highest = max(highest, int(suffix))
+    conn.execute("INSERT OR IGNORE INTO id_sequences (name, value) VALUES ('images', ?)", (highest,))
+
+def _migration_file_unique_id(conn: sqlite3.Connection) -> None:
+    """Schema v8: uniquely indexed Telegram file_unique_id for duplicate-upload detection."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(images)")}
+    if 'file_unique_id' not in columns:
+        conn.execute("ALTER TABLE images ADD COLUMN file_unique_id TEXT")
+    # Images stored before v8 have no file_unique_id; NULLs never collide in a UNIQUE index
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_images_file_unique_id ON images (file_unique_id)")
+
+def _migration_message_state(conn: sqlite3.Connection) -> None:
+    """Schema v9: forwarded message mappings, Group B responses and pending custom amounts."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS forwarded_msgs (
+        image_id TEXT PRIMARY KEY,
+        group_a_chat_id INTEGER,
+        group_a_msg_id INTEGER,
+        group_b_chat_id INTEGER,
+        group_b_msg_id INTEGER,
+        number TEXT,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_forwarded_msgs_group_b_msg ON forwarded_msgs (group_b_chat_id, group_b_msg_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_forwarded_msgs_group_b_number ON forwarded_msgs (group_b_chat_id, number)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_forwarded_msgs_updated_at ON forwarded_msgs (updated_at)")
+    
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS group_b_responses (
+        image_id TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_b_responses_updated_at ON group_b_responses (updated_at)")
+    
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS pending_custom_amounts (
+        message_id INTEGER PRIMARY KEY,
+        img_id TEXT,
+        responder INTEGER,
+        reply_to_msg_id INTEGER,
+        data TEXT NOT NULL,
+        timestamp TEXT
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_custom_amounts_img ON pending_custom_amounts (img_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_custom_amounts_reply_to ON pending_custom_amounts (reply_to_msg_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_custom_amounts_timestamp ON pending_custom_amounts (timestamp)")
+
+def _migration_archived_state(conn: sqlite3.Connection) -> None:
+    """Schema v10: cold store for message state evicted from the working set."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS archived_state (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        namespace TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data TEXT NOT NULL,
+        archived_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_state_key ON archived_state (namespace, key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archived_state_archived_at ON archived_state (archived_at)")
+
+def _migration_config(conn: sqlite3.Connection) -> None:
+    """Schema v11: bot configuration as one JSON value per key, with a change counter."""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS config (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO id_sequences (name, value) VALUES ('config', 0)")
+
+def _migration_pending_updated_at(conn: sqlite3.Connection) -> None:
+    """Schema v12: epoch write time of pending custom amounts, so their TTL survives restarts."""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(pending_custom_amounts)")}
+    if 'updated_at' not in columns:
+        conn.execute("ALTER TABLE pending_custom_amounts ADD COLUMN updated_at REAL")
+    # Existing rows were written when they were submitted
+    now = time.time()
+    conn.executemany(
+        "UPDATE pending_custom_amounts SET updated_at = ? WHERE message_id = ?",
+        [(_epoch_from_iso(timestamp, now), message_id) for message_id, timestamp in
+         conn.execute("SELECT message_id, timestamp FROM pending_custom_amounts WHERE updated_at IS NULL")]
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_pending_custom_amounts_updated_at ON pending_custom_amounts (updated_at)")
+
+def _migration_config_triggers(conn: sqlite3.Connection) -> None:
+    """Schema v13: bump the config version on every change to the config table, hand edits included."""
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS config_version_on_{event.lower()} AFTER {event} ON config
+        BEGIN
+            UPDATE id_sequences SET value = value + 1 WHERE name = 'config';
+        END
+        ''')
+
+# Schema migrations in order; PRAGMA user_version stores how many have been applied
+MIGRATIONS = [
+    _migration_create_images,
+    _migration_add_metadata,
+    _migration_group_columns,
+    _migration_status_number_index,
+    _migration_dispatch_state,
+    _migration_inventory_counters,
+    _migration_id_sequence,
+    _migration_file_unique_id,
+    _migration_message_state,
+    _migration_archived_state,
+    _migration_config,
+    _migration_pending_updated_at,
+    _migration_config_triggers,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate_db(conn: Optional[sqlite3.Connection] = None) -> int:
+    """Bring the database schema up to SCHEMA_VERSION and return the resulting version."""
+    if conn is None:
+        conn = get_connection()
+    
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        # Take the write lock before re-reading the version so concurrent processes migrate once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for index in range(version, SCHEMA_VERSION):
+                MIGRATIONS[index](conn)
+                logger.info(f"Applied schema migration {index + 1}: {MIGRATIONS[index].__doc__}")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Database schema migrated from version {version} to {SCHEMA_VERSION}")
+    elif version > SCHEMA_VERSION:
+        logger.warning(f"Database schema version {version} is newer than supported version {SCHEMA_VERSION}")
+    
+    _initialized_files.add(DB_FILE)
+    return max(version, SCHEMA_VERSION)
+
+def init_db():
+    """Initialize the database and apply any pending schema migrations."""
+    try:
+        migrate_db()
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
 
-def add_image(image_id: str, number: int, file_id: str, status='open', metadata=None) -> bool:
-    """Add an image to the database."""
-    logger.info(f"Adding image: ID={image_id}, number={number}, file_id={file_id}")
-    try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if image_id already exists
-        cursor.execute("SELECT image_id FROM images WHERE image_id = ?", (image_id,))
-        if cursor.fetchone():
-            logger.warning(f"Image ID {image_id} already exists")
-            conn.close()
-            return False
-        
-        # Check if table has metadata column
-        cursor.execute("PRAGMA table_info(images)")
-        has_metadata = any(col[1] == 'metadata' for col in cursor.fetchall())
+def _group_ids_from_metadata(metadata) -> Tuple[Optional[int], Optional[int]]:
+    """Extract (source_group_b_id, target_group_a_id) from a metadata JSON string or dict."""
+    if isinstance(metadata, str):
+        try:
+            metadata = json.loads(metadata)
+        except (ValueError, TypeError, json.JSONDecodeError) as e:
+            logger.error(f"Error parsing metadata {metadata}: {e}")
+            return None, None
+    
+    if not isinstance(metadata, dict):
+        return None, None
+    
+    group_ids = []
+    for key in ('source_group_b_id', 'target_group_a_id'):
+        try:
+            group_ids.append(int(metadata[key]) if metadata.get(key) is not None else None)
+        except (ValueError, TypeError) as e:
+            logger.error(f"Invalid {key} in metadata {metadata}: {e}")
+            group_ids.append(None)
+    return group_ids[0], group_ids[1]
+
+def _row_to_image(row: Tuple) -> Dict:
+    """Convert an IMAGE_COLUMNS row into an image dict with decoded metadata."""
+    image = {
+        'image_id': row[0],
+        'number': row[1],
+        'file_id': row[2],
+        'status': row[3]
+    }
+    
+    # Add metadata if available
+    if row[4]:
+        try:
+            image['metadata'] = json.loads(row[4])
+        except (ValueError, TypeError, json.JSONDecodeError) as e:
+            logger.error(f"Error parsing metadata for image {row[0]}: {e}")
+            image['metadata'] = {}
+    
+    return image
+
+class Image:
+    """Compact image record whose metadata JSON is decoded on first access.
+    
+    Supports the dict-style access (image['status'], image.get('metadata'), 'metadata' in image)
+    used for image dicts, where 'metadata' is only present when the row has some.
+    """
+    __slots__ = ('image_id', 'number', 'file_id', 'status', 'source_group_b_id', '_raw_metadata', '_metadata')
+    
+    _FIELDS = ('image_id', 'number', 'file_id', 'status')
+    _UNDECODED = object()
+    
+    def __init__(self, image_id: str, number: int, file_id: str, status: str,
+                 raw_metadata: Optional[str] = None, source_group_b_id: Optional[int] = None):
+        self.image_id = image_id
+        self.number = number
+        self.file_id = file_id
+        self.status = status
+        self.source_group_b_id = source_group_b_id
+        self._raw_metadata = raw_metadata
+        self._metadata = Image._UNDECODED
+    
+    @property
+    def metadata(self) -> Optional[Dict]:
+        """Decoded metadata dict, or None when the row has no metadata."""
+        if self._metadata is Image._UNDECODED:
+            if not self._raw_metadata:
+                self._metadata = None
+            else:
+                try:
+                    self._metadata = json.loads(self._raw_metadata)
+                except (ValueError, TypeError, json.JSONDecodeError) as e:
+                    logger.error(f"Error parsing metadata for image {self.image_id}: {e}")
+                    self._metadata = {}
+        return self._metadata
+    
+    def __contains__(self, key: str) -> bool:
+        if key == 'metadata':
+            return bool(self._raw_metadata)
+        return key in Image._FIELDS
+    
+    def __getitem__(self, key: str):
+        if key == 'metadata' and self._raw_metadata:
+            return self.metadata
+        if key in Image._FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+    
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def to_dict(self) -> Dict:
+        image = {field: getattr(self, field) for field in Image._FIELDS}
+        if self._raw_metadata:
+            image['metadata'] = self.metadata
+        return image
+    
+    def __repr__(self) -> str:
+        return f"Image(image_id={self.image_id!r}, number={self.number!r}, status={self.status!r})"
+
+# Rows fetched per page by iter_images
+ITER_IMAGES_BATCH_SIZE = 500
+
+def iter_images(status: Optional[str] = None, group_b_id: Optional[int] = None,
+                number: Optional[int] = None, batch_size: int = ITER_IMAGES_BATCH_SIZE):
+    """Stream Image records matching the optional filters in constant memory.
+    
+    Rows are read in rowid-keyset pages rather than from one long-lived cursor, so callers
+    may write to the database (e.g. update metadata) while iterating.
+    """
+    where = ["rowid > ?"]
+    filters: List = []
+    if status is not None:
+        where.append("status = ?")
+        filters.append(status)
+    if group_b_id is not None:
+        where.append("source_group_b_id = ?")
+        filters.append(int(group_b_id))
+    if number is not None:
+        where.append("number = ?")
+        filters.append(int(number))
+    query = (
+        f"SELECT rowid, {IMAGE_COLUMNS}, source_group_b_id FROM images "
+        f"WHERE {' AND '.join(where)} ORDER BY rowid LIMIT ?"
+    )
+    
+    last_rowid = 0
+    while True:
+        rows = get_connection().execute(query, [last_rowid] + filters + [batch_size]).fetchall()
+        for row in rows:
+            yield Image(row[1], row[2], row[3], row[4], row[5], row[6])
+        if len(rows) < batch_size:
+            return
+        last_rowid = rows[-1][0]
+
+# Maximum number of decoded images kept in the write-through cache
+IMAGE_CACHE_SIZE = 2048
+
+class ImageCache:
+    """Bounded LRU write-through cache of decoded images keyed by image_id.
+    
+    Every db function that changes an image updates the cache after its commit. Secondary
+    indexes by status, number and source Group B let bulk updates and deletes touch only the
+    affected entries. Reads return copies so callers can't mutate cached state.
+    """
+    
+    def __init__(self, max_size: int = IMAGE_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._images: "OrderedDict[str, Dict]" = OrderedDict()
+        self._groups: Dict[str, Optional[int]] = {}  # Format: {image_id: source_group_b_id}
+        self._by_status: Dict[str, set] = {}
+        self._by_number: Dict[int, set] = {}
+        self._by_group: Dict[Optional[int], set] = {}
+        self._loaded_from = DB_FILE
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _check_file(self) -> None:
+        if self._loaded_from != DB_FILE:
+            self._clear()
+            self._loaded_from = DB_FILE
+    
+    def _index(self, image_id: str) -> None:
+        image = self._images[image_id]
+        self._by_status.setdefault(image['status'], set()).add(image_id)
+        self._by_number.setdefault(image['number'], set()).add(image_id)
+        self._by_group.setdefault(self._groups[image_id], set()).add(image_id)
+    
+    def _unindex(self, image_id: str) -> None:
+        image = self._images[image_id]
+        for index, key in ((self._by_status, image['status']),
+                           (self._by_number, image['number']),
+                           (self._by_group, self._groups[image_id])):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(image_id)
+                if not ids:
+                    del index[key]
+    
+    def _remove(self, image_id: str) -> None:
+        if image_id in self._images:
+            self._unindex(image_id)
+            del self._images[image_id]
+            del self._groups[image_id]
+    
+    def _clear(self) -> None:
+        self._images.clear()
+        self._groups.clear()
+        self._by_status.clear()
+        self._by_number.clear()
+        self._by_group.clear()
+    
+    def get(self, image_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._check_file()
+            image = self._images.get(image_id)
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(image_id)
+            return copy.deepcopy(image)
+    
+    def _put(self, image: Dict, group_b_id: Optional[int]) -> None:
+        image_id = image['image_id']
+        self._remove(image_id)
+        self._images[image_id] = copy.deepcopy(image)
+        self._groups[image_id] = group_b_id
+        self._index(image_id)
+        while len(self._images) > self.max_size:
+            self._remove(next(iter(self._images)))
+            self.evictions += 1
+    
+    def put(self, image: Dict, group_b_id: Optional[int] = None) -> None:
+        """Store a decoded image (replacing any cached copy) and evict beyond max_size."""
+        with self._lock:
+            self._check_file()
+            self._put(image, group_b_id)
+    
+    def put_metadata(self, image: Dict, group_b_id: Optional[int]) -> None:
+        """Write an image's new metadata through to the cache.
+        
+        A cached entry keeps its other fields (which may be newer than the caller's row);
+        an uncached image is stored whole.
+        """
+        with self._lock:
+            self._check_file()
+            image_id = image['image_id']
+            if image_id not in self._images:
+                self._put(image, group_b_id)
+                return
+            self._unindex(image_id)
+            cached = self._images[image_id]
+            if 'metadata' in image:
+                cached['metadata'] = copy.deepcopy(image['metadata'])
+            else:
+                cached.pop('metadata', None)
+            self._groups[image_id] = group_b_id
+            self._index(image_id)
+            self._images.move_to_end(image_id)
+    
+    def update(self, image_id: str, **fields) -> None:
+        """Update fields of a cached image, if it is cached."""
+        with self._lock:
+            self._check_file()
+            if image_id not in self._images:
+                return
+            self._unindex(image_id)
+            group_b_id = fields.pop('source_group_b_id', self._groups[image_id])
+            self._images[image_id].update(copy.deepcopy(fields))
+            self._groups[image_id] = group_b_id
+            self._index(image_id)
+    
+    def set_all_status(self, status: str) -> None:
+        """Apply a table-wide status change to every cached image."""
+        with self._lock:
+            self._check_file()
+            for image_id in list(self._images):
+                self._images[image_id]['status'] = status
+            self._by_status = {status: set(self._images)} if self._images else {}
+    
+    def discard(self, image_id: str) -> None:
+        with self._lock:
+            self._check_file()
+            self._remove(image_id)
+    
+    def discard_group(self, group_b_id: int) -> None:
+        with self._lock:
+            self._check_file()
+            for image_id in list(self._by_group.get(group_b_id, ())):
+                self._remove(image_id)
+    
+    def discard_number(self, number: int, group_b_id: int) -> None:
+        with self._lock:
+            self._check_file()
+            matching = self._by_number.get(number, set()) & self._by_group.get(group_b_id, set())
+            for image_id in matching:
+                self._remove(image_id)
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._images),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'open': len(self._by_status.get('open', ())),
+                'closed': len(self._by_status.get('closed', ()))
+            }
+
+image_cache = ImageCache()
+
+def get_cache_stats() -> Dict:
+    """Get image cache statistics."""
+    return image_cache.stats()
+
+class _SampleBucket:
+    """Set of image IDs with O(1) add, remove and uniform random choice."""
+    
+    def __init__(self):
+        self._ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+    
+    def __len__(self) -> int:
+        return len(self._ids)
+    
+    def __iter__(self):
+        return iter(list(self._ids))
+    
+    def add(self, image_id: str) -> None:
+        if image_id not in self._positions:
+            self._positions[image_id] = len(self._ids)
+            self._ids.append(image_id)
+    
+    def discard(self, image_id: str) -> None:
+        position = self._positions.pop(image_id, None)
+        if position is None:
+            return
+        # Move the last ID into the freed slot so the list stays dense
+        last_id = self._ids.pop()
+        if last_id != image_id:
+            self._ids[position] = last_id
+            self._positions[last_id] = position
+    
+    def choice(self) -> Optional[str]:
+        return random.choice(self._ids) if self._ids else None
+
+class OpenImageIndex:
+    """In-memory index of open image IDs, overall and per Group B, for O(1) random sampling.
+    
+    Loaded from the database on first use and kept in sync by every db function that
+    changes an image's status, group or existence. Sampled IDs are re-checked against
+    the database, so an entry made stale by an outside writer is dropped, not served.
+    """
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded_from = None  # DB_FILE the index was built from
+        self._all = _SampleBucket()
+        self._by_group: Dict[Optional[int], _SampleBucket] = {}
+        self._groups: Dict[str, Optional[int]] = {}  # Format: {image_id: source_group_b_id}
+        self.groups_version = 0  # Bumped whenever a Group B bucket appears or empties
+    
+    def _ensure_loaded(self, conn: sqlite3.Connection) -> None:
+        if self._loaded_from == DB_FILE:
+            return
+        self._all = _SampleBucket()
+        self._by_group = {}
+        self._groups = {}
+        for image_id, group_b_id in conn.execute("SELECT image_id, source_group_b_id FROM images WHERE status = 'open'"):
+            self._add(image_id, group_b_id)
+        self._loaded_from = DB_FILE
+        self.groups_version += 1
+        logger.info(f"Loaded open image index with {len(self._all)} images")
+    
+    def _add(self, image_id: str, group_b_id: Optional[int]) -> None:
+        if image_id in self._groups:
+            self._discard(image_id)
+        self._all.add(image_id)
+        if group_b_id not in self._by_group:
+            self._by_group[group_b_id] = _SampleBucket()
+            self.groups_version += 1
+        self._by_group[group_b_id].add(image_id)
+        self._groups[image_id] = group_b_id
+    
+    def _discard(self, image_id: str) -> None:
+        if image_id not in self._groups:
+            return
+        group_b_id = self._groups.pop(image_id)
+        self._all.discard(image_id)
+        bucket = self._by_group.get(group_b_id)
+        if bucket is not None:
+            bucket.discard(image_id)
+            if not bucket:
+                del self._by_group[group_b_id]
+                self.groups_version += 1
+    
+    def add(self, image_id: str, group_b_id: Optional[int]) -> None:
+        """Record an image as open (no-op until the index has been loaded)."""
+        with self._lock:
+            if self._loaded_from == DB_FILE:
+                self._add(image_id, group_b_id)
+    
+    def discard(self, image_id: str) -> None:
+        """Record an image as no longer open."""
+        with self._lock:
+            self._discard(image_id)
+    
+    def discard_group(self, group_b_id: int) -> None:
+        """Drop every open image of a Group B, touching only that group's entries."""
+        with self._lock:
+            bucket = self._by_group.get(group_b_id)
+            if bucket is not None:
+                for image_id in bucket:
+                    self._discard(image_id)
+    
+    def invalidate(self) -> None:
+        """Forget the index so it is rebuilt from the database on next use."""
+        with self._lock:
+            self._loaded_from = None
+    
+    def sample(self, conn: sqlite3.Connection, group_b_id: Optional[int] = None) -> Optional[str]:
+        """Get a uniformly random open image ID, optionally limited to a Group B."""
+        with self._lock:
+            self._ensure_loaded(conn)
+            if group_b_id is None:
+                return self._all.choice()
+            bucket = self._by_group.get(group_b_id)
+            return bucket.choice() if bucket is not None else None
+    
+    def sample_group(self, conn: sqlite3.Connection, group_b_id: Optional[int]) -> Optional[str]:
+        """Get a uniformly random open image ID of one Group B bucket (None for ungrouped images)."""
+        with self._lock:
+            self._ensure_loaded(conn)
+            bucket = self._by_group.get(group_b_id)
+            return bucket.choice() if bucket is not None else None
+    
+    def open_groups(self, conn: sqlite3.Connection) -> List[Optional[int]]:
+        """Get the Group B IDs (None for ungrouped images) that have open images."""
+        with self._lock:
+            self._ensure_loaded(conn)
+            return list(self._by_group)
+    
+    def count(self, conn: sqlite3.Connection, group_b_id: Optional[int] = None) -> int:
+        """Get the number of open images, optionally limited to a Group B."""
+        with self._lock:
+            self._ensure_loaded(conn)
+            if group_b_id is None:
+                return len(self._all)
+            return len(self._by_group.get(group_b_id, ()))
+
+_open_images = OpenImageIndex()
+
+class AliasTable:
+    """Vose alias table: O(1) sampling from a fixed weighted distribution."""
+    
+    def __init__(self, items: List, weights: List[float]):
+        total = float(sum(weights))
+        count = len(items)
+        self._items = list(items)
+        self._probability = [0.0] * count
+        self._alias = [0] * count
+        
+        scaled = [weight * count / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probability[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Whatever is left over is 1.0 up to floating point error
+        for i in small + large:
+            self._probability[i] = 1.0
+    
+    def sample(self):
+        column = random.randrange(len(self._items))
+        if random.random() < self._probability[column]:
+            return self._items[column]
+        return self._items[self._alias[column]]
+
+# Weight for Group Bs without a configured percentage (and for ungrouped images)
+DEFAULT_GROUP_B_WEIGHT = 100
+
+class GroupBSelector:
+    """Picks which Group B bucket the next image comes from, weighted by group_b_percentages.
+    
+    The alias table is rebuilt only when the percentages or the set of Group Bs with open
+    images change; every other pick is O(1).
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._table: Optional[AliasTable] = None
+        self.rebuilds = 0
+    
+    def pick_group(self, conn: sqlite3.Connection, group_b_percentages: Optional[Dict] = None) -> Tuple[bool, Optional[int]]:
+        """Return (found, group_b_id); found is False when no open images exist."""
+        percentages = {int(k): v for k, v in (group_b_percentages or {}).items()}
+        with self._lock:
+            signature = (tuple(sorted(percentages.items())), _open_images.groups_version, DB_FILE)
+            if signature != self._signature:
+                self._rebuild(conn, percentages)
+                self._signature = signature
+            if self._table is None:
+                return False, None
+            return True, self._table.sample()
+    
+    def _rebuild(self, conn: sqlite3.Connection, percentages: Dict[int, int]) -> None:
+        groups = _open_images.open_groups(conn)
+        weights = [percentages.get(group, DEFAULT_GROUP_B_WEIGHT) if group is not None else DEFAULT_GROUP_B_WEIGHT
+                   for group in groups]
+        if groups and sum(weights) <= 0:
+            # Every group with stock is at 0%, still hand out an image rather than nothing
+            weights = [1] * len(groups)
+        self._table = AliasTable(groups, weights) if groups else None
+        self.rebuilds += 1
+        logger.info(f"Rebuilt Group B sampler: {dict(zip(groups, weights))}")
+
+_group_b_selector = GroupBSelector()
+
+def _lowest_open_image_row_in_group(conn: sqlite3.Connection, group_b_id: Optional[int]) -> Optional[Tuple]:
+    """Get the lowest-numbered open image of a Group B (None for ungrouped images).
+    
+    Drops the group's open index bucket if the database shows it has no open images.
+    """
+    if group_b_id is None:
+        row = conn.execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images WHERE source_group_b_id IS NULL AND status = 'open' "
+            "ORDER BY number ASC, image_id ASC LIMIT 1"
+        ).fetchone()
+    else:
+        row = conn.execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images WHERE source_group_b_id = ? AND status = 'open' "
+            "ORDER BY number ASC, image_id ASC LIMIT 1",
+            (group_b_id,)
+        ).fetchone()
+    
+    if not row:
+        # The index thought this group had stock but the database disagrees
+        logger.warning(f"Open image index bucket for Group B {group_b_id} was stale, dropping it")
+        _open_images.discard_group(group_b_id)
+    return row
+
+def _select_weighted_open_image_row(conn: sqlite3.Connection, group_b_percentages: Optional[Dict] = None) -> Optional[Tuple]:
+    """Pick a Group B by percentage weight, then its lowest-numbered open image."""
+    while True:
+        found, group_b_id = _group_b_selector.pick_group(conn, group_b_percentages)
+        if not found:
+            return None
         
-        # Add metadata column if it doesn't exist
-        if not has_metadata:
-            cursor.execute("ALTER TABLE images ADD COLUMN metadata TEXT")
-            conn.commit()
-            logger.info("Added metadata column to images table")
+        row = _lowest_open_image_row_in_group(conn, group_b_id)
+        if row:
+            return row
+
+# Stride scheduling: a group's pass advances by STRIDE_SCALE / weight each time it is served
+STRIDE_SCALE = 10000.0
+# Key stored in dispatch_state for images without a source Group B (chat IDs are never 0)
+UNGROUPED_KEY = 0
+
+class ShareDispatcher:
+    """Stride scheduler that serves Group Bs so their realised shares converge to their percentages.
+    
+    Each Group B with open images is eligible; the one with the lowest pass is served and its
+    pass advances by STRIDE_SCALE / percentage. A group returning after running dry starts at
+    the current virtual time instead of its stale pass, so it can't burst. Served counts and
+    passes are written to dispatch_state in the claim's own transaction, so they survive restarts.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_from = None
+        self._served: Dict[int, int] = {}  # Format: {group_key: images served}
+        self._pass: Dict[int, float] = {}  # Format: {group_key: pass value}
+        self._virtual_time = 0.0
+    
+    def _ensure_loaded(self, conn: sqlite3.Connection) -> None:
+        if self._loaded_from == DB_FILE:
+            return
+        rows = conn.execute("SELECT group_key, served, pass FROM dispatch_state").fetchall()
+        self._served = {row[0]: row[1] for row in rows}
+        self._pass = {row[0]: row[2] for row in rows}
+        self._virtual_time = min(self._pass.values()) if self._pass else 0.0
+        self._loaded_from = DB_FILE
+        logger.info(f"Loaded dispatch state for {len(rows)} Group Bs")
+    
+    def invalidate(self) -> None:
+        """Forget the in-memory state so it is reloaded from the database on next use."""
+        with self._lock:
+            self._loaded_from = None
+    
+    @staticmethod
+    def _weights(groups: List[Optional[int]], percentages: Dict[int, int]) -> Dict[Optional[int], float]:
+        weights = {group: float(percentages.get(group, DEFAULT_GROUP_B_WEIGHT)) if group is not None
+                   else float(DEFAULT_GROUP_B_WEIGHT) for group in groups}
+        if groups and not any(weight > 0 for weight in weights.values()):
+            # Every group with stock is at 0%, share evenly rather than hand out nothing
+            weights = {group: 1.0 for group in groups}
+        return weights
+    
+    def _effective_pass(self, group_b_id: Optional[int]) -> float:
+        key = UNGROUPED_KEY if group_b_id is None else group_b_id
+        return max(self._pass.get(key, self._virtual_time), self._virtual_time)
+    
+    def pick_group(self, conn: sqlite3.Connection, group_b_percentages: Optional[Dict] = None) -> Tuple[bool, Optional[int]]:
+        """Return (found, group_b_id) for the Group B due next; found is False when no open images exist."""
+        percentages = {int(k): v for k, v in (group_b_percentages or {}).items()}
+        with self._lock:
+            self._ensure_loaded(conn)
+            weights = self._weights(_open_images.open_groups(conn), percentages)
+            eligible = [group for group, weight in weights.items() if weight > 0]
+            if not eligible:
+                return False, None
+            group_b_id = min(eligible, key=lambda group: (self._effective_pass(group), UNGROUPED_KEY if group is None else group))
+            return True, group_b_id
+    
+    def record(self, conn: sqlite3.Connection, group_b_id: Optional[int], group_b_percentages: Optional[Dict] = None) -> None:
+        """Charge one served image to a Group B (call inside the claiming transaction)."""
+        percentages = {int(k): v for k, v in (group_b_percentages or {}).items()}
+        key = UNGROUPED_KEY if group_b_id is None else group_b_id
+        with self._lock:
+            self._ensure_loaded(conn)
+            weight = self._weights([group_b_id], percentages)[group_b_id]
+            start = self._effective_pass(group_b_id)
+            self._virtual_time = start
+            self._pass[key] = start + STRIDE_SCALE / weight
+            self._served[key] = self._served.get(key, 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO dispatch_state (group_key, served, pass) VALUES (?, ?, ?)",
+                (key, self._served[key], self._pass[key])
+            )
+    
+    def unrecord(self, conn: sqlite3.Connection, group_b_id: Optional[int], group_b_percentages: Optional[Dict] = None) -> None:
+        """Take back a record() for an image that was never delivered (call inside the releasing transaction)."""
+        percentages = {int(k): v for k, v in (group_b_percentages or {}).items()}
+        key = UNGROUPED_KEY if group_b_id is None else group_b_id
+        with self._lock:
+            self._ensure_loaded(conn)
+            if not self._served.get(key):
+                return
+            weight = self._weights([group_b_id], percentages)[group_b_id]
+            self._pass[key] = max(self._pass[key] - STRIDE_SCALE / weight, self._virtual_time)
+            self._served[key] -= 1
+            conn.execute(
+                "INSERT OR REPLACE INTO dispatch_state (group_key, served, pass) VALUES (?, ?, ?)",
+                (key, self._served[key], self._pass[key])
+            )
+    
+    def share_report(self, conn: sqlite3.Connection, group_b_ids, group_b_percentages: Optional[Dict] = None) -> List[Dict]:
+        """Configured vs realised share for every known or served Group B."""
+        percentages = {int(k): v for k, v in (group_b_percentages or {}).items()}
+        with self._lock:
+            self._ensure_loaded(conn)
+            served = dict(self._served)
+        
+        groups = set(int(group) for group in group_b_ids) | set(percentages)
+        groups |= set(None if key == UNGROUPED_KEY else key for key in served)
+        groups = sorted(groups, key=lambda group: UNGROUPED_KEY if group is None else group)
+        weights = {group: float(percentages.get(group, DEFAULT_GROUP_B_WEIGHT)) if group is not None
+                   else float(DEFAULT_GROUP_B_WEIGHT) for group in groups}
+        total_weight = sum(weights.values())
+        total_served = sum(served.values())
+        
+        report = []
+        for group in groups:
+            count = served.get(UNGROUPED_KEY if group is None else group, 0)
+            report.append({
+                'group_b_id': group,
+                'percentage': percentages.get(group, DEFAULT_GROUP_B_WEIGHT) if group is not None else None,
+                'configured_share': weights[group] / total_weight if total_weight else 0.0,
+                'realised_share': count / total_served if total_served else 0.0,
+                'served': count
+            })
+        return report
+
+_share_dispatcher = ShareDispatcher()
+
+def _select_share_open_image_row(conn: sqlite3.Connection, group_b_percentages: Optional[Dict] = None) -> Tuple[Optional[Tuple], Optional[int]]:
+    """Pick the Group B whose share is most behind, then a random open image of it."""
+    while True:
+        found, group_b_id = _share_dispatcher.pick_group(conn, group_b_percentages)
+        if not found:
+            return None, None
+        
+        row = _sample_open_image_row(conn, group_b_id, exact_group=True)
+        if row:
+            return row, group_b_id
+
+def get_share_report(group_b_ids, group_b_percentages: Optional[Dict] = None) -> List[Dict]:
+    """Get configured vs realised image share per Group B from the fair-share dispatcher."""
+    try:
+        return _share_dispatcher.share_report(get_connection(), group_b_ids, group_b_percentages)
+    except Exception as e:
+        logger.error(f"Error building Group B share report: {e}")
+        return []
+
+def _sample_open_image_row(conn: sqlite3.Connection, group_b_id: Optional[int] = None,
+                           exact_group: bool = False) -> Optional[Tuple]:
+    """Pick a uniformly random open image row using the open image index.
+    
+    group_b_id None means any group, unless exact_group is set, which limits it to ungrouped images.
+    """
+    while True:
+        if exact_group:
+            image_id = _open_images.sample_group(conn, group_b_id)
+        else:
+            image_id = _open_images.sample(conn, group_b_id)
+        if image_id is None:
+            return None
         
-        # Insert new image with metadata
-        cursor.execute(
-            "INSERT INTO images (image_id, number, file_id, status, metadata) VALUES (?, ?, ?, ?, ?)",
-            (image_id, number, file_id, status, metadata)
-        )
+        row = conn.execute(
+            f"SELECT {IMAGE_COLUMNS}, source_group_b_id FROM images WHERE image_id = ?", (image_id,)
+        ).fetchone()
+        if row and row[3] == 'open' and ((group_b_id is None and not exact_group) or row[5] == group_b_id):
+            return row[:5]
         
-        conn.commit()
-        conn.close()
+        # Changed behind the index's back (e.g. by another process), drop it and retry
+        logger.warning(f"Open image index entry {image_id} was stale, dropping it")
+        _open_images.discard(image_id)
+
+# Image IDs are IMAGE_ID_PREFIX + a sequence number
+IMAGE_ID_PREFIX = "img_"
+# Sequence values reserved per database round trip; unused ones are skipped after a restart
+ID_BLOCK_SIZE = 50
+
+_id_lock = threading.Lock()
+_id_block = {'db_file': None, 'next': 0, 'end': 0}
+
+def allocate_image_id() -> str:
+    """Allocate a unique image ID without reading the images table.
+    
+    IDs come from the id_sequences table in blocks of ID_BLOCK_SIZE, so most calls are served
+    from memory under a lock and concurrent run_async uploads never collide.
+    """
+    with _id_lock:
+        if _id_block['db_file'] != DB_FILE or _id_block['next'] >= _id_block['end']:
+            conn = get_connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("UPDATE id_sequences SET value = value + ? WHERE name = 'images'", (ID_BLOCK_SIZE,))
+                end = conn.execute("SELECT value FROM id_sequences WHERE name = 'images'").fetchone()[0]
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            _id_block.update({'db_file': DB_FILE, 'next': end - ID_BLOCK_SIZE + 1, 'end': end + 1})
+        
+        value = _id_block['next']
+        _id_block['next'] += 1
+    return f"{IMAGE_ID_PREFIX}{value}"
+
+def add_image(image_id: str, number: int, file_id: str, status='open', metadata=None, file_unique_id=None) -> bool:
+    """Add an image to the database.
+    
+    file_unique_id is Telegram's stable per-photo ID; an image whose file_unique_id is already
+    stored is rejected as a duplicate upload.
+    """
+    logger.info(f"Adding image: ID={image_id}, number={number}, file_id={file_id}")
+    try:
+        conn = get_connection()
+        source_group_b_id, target_group_a_id = _group_ids_from_metadata(metadata)
+        
+        with conn:
+            # Check if image_id already exists
+            if conn.execute("SELECT 1 FROM images WHERE image_id = ?", (image_id,)).fetchone():
+                logger.warning(f"Image ID {image_id} already exists")
+                return False
+            
+            # Same photo uploaded before - single probe of the unique file_unique_id index
+            if file_unique_id is not None:
+                duplicate = conn.execute(
+                    "SELECT image_id FROM images WHERE file_unique_id = ?", (file_unique_id,)
+                ).fetchone()
+                if duplicate:
+                    logger.warning(f"Photo {file_unique_id} is already stored as image {duplicate[0]}")
+                    return False
+            
+            # Insert new image with metadata, keeping the indexed group columns in sync
+            conn.execute(
+                "INSERT INTO images (image_id, number, file_id, status, metadata, source_group_b_id, target_group_a_id, file_unique_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (image_id, number, file_id, status, metadata, source_group_b_id, target_group_a_id, file_unique_id)
+            )
+        
+        if status == 'open':
+            _open_images.add(image_id, source_group_b_id)
+        image_cache.put(_row_to_image((image_id, number, file_id, status, metadata)), source_group_b_id)
         logger.info(f"Added image {image_id} for group {number} with status '{status}'")
         return True
     except sqlite3.IntegrityError as e:
@@ -96,49 +1222,99 @@ def add_image(image_id: str, number: int, file_id: str, status='open', metadata=
         logger.error(f"Error adding image: {e}")
         return False
 
-def get_random_open_image() -> Optional[Dict]:
-    """Get a random open image from the database."""
+def get_image_by_file_unique_id(file_unique_id: str) -> Optional[Dict]:
+    """Get the image stored for a Telegram file_unique_id, if any."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
+        row = get_connection().execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images WHERE file_unique_id = ?", (file_unique_id,)
+        ).fetchone()
+        return _row_to_image(row) if row else None
+    except Exception as e:
+        logger.error(f"Error getting image by file_unique_id {file_unique_id}: {e}")
+        return None
+
+def _probe_existing(conn: sqlite3.Connection, column: str, values: List) -> set:
+    """Return which of values are already stored in an indexed images column."""
+    existing = set()
+    # SQLite caps bound parameters, so probe in chunks
+    for start in range(0, len(values), 500):
+        chunk = values[start:start + 500]
+        placeholders = ', '.join(['?'] * len(chunk))
+        existing.update(r[0] for r in conn.execute(
+            f"SELECT {column} FROM images WHERE {column} IN ({placeholders})", chunk
+        ))
+    return existing
+
+def add_images(images: List[Tuple]) -> Tuple[int, int]:
+    """Add many images in one transaction and return (inserted, duplicates).
+    
+    Each entry is (image_id, number, file_id, status, metadata, file_unique_id) as for add_image.
+    Entries whose image_id already exists are skipped; entries whose file_unique_id is already
+    stored, or repeats an earlier entry of the batch, are skipped and counted as duplicates.
+    """
+    logger.info(f"Adding batch of {len(images)} images")
+    try:
+        conn = get_connection()
+        
+        rows = []
+        for image_id, number, file_id, status, metadata, file_unique_id in images:
+            source_group_b_id, target_group_a_id = _group_ids_from_metadata(metadata)
+            rows.append((image_id, number, file_id, status, metadata, source_group_b_id, target_group_a_id, file_unique_id))
+        
+        # Take the write lock before probing so no other connection can insert in between
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Drop IDs that already exist
+            existing = _probe_existing(conn, 'image_id', [row[0] for row in rows])
+            if existing:
+                logger.warning(f"Skipping {len(existing)} image IDs that already exist: {sorted(existing)}")
+                rows = [row for row in rows if row[0] not in existing]
+            
+            # Drop photos that are already stored or appear twice in this batch
+            seen = _probe_existing(conn, 'file_unique_id', [row[7] for row in rows if row[7] is not None])
+            unique_rows = []
+            for row in rows:
+                if row[7] is not None:
+                    if row[7] in seen:
+                        continue
+                    seen.add(row[7])
+                unique_rows.append(row)
+            duplicates = len(rows) - len(unique_rows)
+            rows = unique_rows
+            if duplicates:
+                logger.warning(f"Skipping {duplicates} duplicate photos in batch")
+            
+            conn.executemany(
+                "INSERT INTO images (image_id, number, file_id, status, metadata, source_group_b_id, target_group_a_id, file_unique_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         
-        if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE status = 'open'")
-        else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images WHERE status = 'open'")
+        for image_id, number, file_id, status, metadata, source_group_b_id, _, _ in rows:
+            if status == 'open':
+                _open_images.add(image_id, source_group_b_id)
+            image_cache.put(_row_to_image((image_id, number, file_id, status, metadata)), source_group_b_id)
         
-        rows = cursor.fetchall()
+        logger.info(f"Added {len(rows)} of {len(images)} images in batch ({duplicates} duplicates)")
+        return len(rows), duplicates
+    except Exception as e:
+        logger.error(f"Error adding image batch: {e}")
+        return 0, 0
+
+def get_random_open_image() -> Optional[Dict]:
+    """Get a random open image from the database."""
+    try:
+        row = _sample_open_image_row(get_connection())
         
-        if not rows:
+        if not row:
             logger.info("No open images available")
-            conn.close()
             return None
         
-        # Pick a random image
-        row = random.choice(rows)
-        
-        image = {
-            'image_id': row[0],
-            'number': row[1],
-            'file_id': row[2],
-            'status': row[3]
-        }
-        
-        # Add metadata if available
-        if 'metadata' in columns and len(row) > 4 and row[4]:
-            try:
-                image['metadata'] = json.loads(row[4])
-            except (ValueError, TypeError, json.JSONDecodeError) as e:
-                logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                image['metadata'] = {}
-        
-        conn.close()
-        return image
+        return _row_to_image(row)
     except Exception as e:
         logger.error(f"Error getting random open image: {e}")
         return None
@@ -147,64 +1323,132 @@ def set_image_status(image_id: str, status: str) -> bool:
     """Set the status of an image."""
     logger.info(f"Setting image {image_id} status to '{status}'")
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
         
         # Check if image exists
-        cursor.execute("SELECT image_id FROM images WHERE image_id = ?", (image_id,))
-        if not cursor.fetchone():
+        cursor.execute("SELECT source_group_b_id FROM images WHERE image_id = ?", (image_id,))
+        row = cursor.fetchone()
+        if not row:
             logger.warning(f"Image ID {image_id} not found")
-            conn.close()
             return False
         
         # Update status
         cursor.execute("UPDATE images SET status = ? WHERE image_id = ?", (status, image_id))
         
         conn.commit()
-        conn.close()
+        if status == 'open':
+            _open_images.add(image_id, row[0])
+        else:
+            _open_images.discard(image_id)
+        image_cache.update(image_id, status=status)
         logger.info(f"Updated image {image_id} status to '{status}'")
         return True
     except Exception as e:
         logger.error(f"Error setting image status: {e}")
         return False
 
-def get_all_images() -> List[Dict]:
-    """Get all images from the database."""
+# Selection strategies accepted by claim_image
+CLAIM_RANDOM = 'random'
+CLAIM_ASCENDING = 'ascending'
+CLAIM_PERCENTAGE = 'percentage'
+CLAIM_FAIR_SHARE = 'share'
+CLAIM_STRATEGIES = (CLAIM_RANDOM, CLAIM_ASCENDING, CLAIM_PERCENTAGE, CLAIM_FAIR_SHARE)
+
+def _select_open_image_row(conn: sqlite3.Connection, strategy: str, group_b_id: Optional[int] = None,
+                           group_b_percentages: Optional[Dict] = None) -> Optional[Tuple]:
+    """Pick one open image row with the given strategy, optionally limited to a Group B."""
+    if strategy == CLAIM_PERCENTAGE and group_b_id is None:
+        return _select_weighted_open_image_row(conn, group_b_percentages)
+    
+    where = "status = 'open'"
+    params = ()
+    if group_b_id is not None:
+        where += " AND source_group_b_id = ?"
+        params = (int(group_b_id),)
+    
+    if strategy == CLAIM_RANDOM:
+        return _sample_open_image_row(conn, group_b_id)
+    
+    return conn.execute(f"SELECT {IMAGE_COLUMNS} FROM images WHERE {where} ORDER BY number ASC, image_id ASC LIMIT 1", params).fetchone()
+
+def claim_image(strategy: str = CLAIM_RANDOM, group_b_id: Optional[int] = None,
+                group_b_percentages: Optional[Dict] = None) -> Optional[Dict]:
+    """Atomically pick an open image and mark it closed, returning the claimed image."""
+    if strategy not in CLAIM_STRATEGIES:
+        raise ValueError(f"Unknown claim strategy: {strategy}")
+    
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
+        conn = get_connection()
         
-        if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images")
-        else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images")
-        
-        images = []
-        for row in cursor.fetchall():
-            image = {
-                'image_id': row[0],
-                'number': row[1],
-                'file_id': row[2],
-                'status': row[3]
-            }
-            
-            # Add metadata if available
-            if 'metadata' in columns and len(row) > 4 and row[4]:
-                try:
-                    image['metadata'] = json.loads(row[4])
-                except:
-                    image['metadata'] = {}
+        # Take the write lock up front so no other connection can claim the same row in between
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if strategy == CLAIM_FAIR_SHARE and group_b_id is None:
+                row, picked_group_b_id = _select_share_open_image_row(conn, group_b_percentages)
+            else:
+                row = _select_open_image_row(conn, strategy, group_b_id, group_b_percentages)
+            if not row:
+                conn.rollback()
+                logger.info(f"No open images available to claim (strategy={strategy}, group_b_id={group_b_id})")
+                return None
             
-            images.append(image)
-        
-        conn.close()
-        return images
+            conn.execute("UPDATE images SET status = 'closed' WHERE image_id = ? AND status = 'open'", (row[0],))
+            if strategy == CLAIM_FAIR_SHARE and group_b_id is None:
+                _share_dispatcher.record(conn, picked_group_b_id, group_b_percentages)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            _share_dispatcher.invalidate()
+            raise
+        _open_images.discard(row[0])
+        
+        image = _row_to_image(row)
+        image['status'] = 'closed'
+        image_cache.put(image, _group_ids_from_metadata(image.get('metadata'))[0])
+        logger.info(f"Claimed image {image['image_id']} (strategy={strategy}, group_b_id={group_b_id})")
+        return image
+    except Exception as e:
+        logger.error(f"Error claiming image: {e}")
+        return None
+
+def release_claimed_image(image_id: str, strategy: str = CLAIM_RANDOM,
+                          group_b_percentages: Optional[Dict] = None) -> bool:
+    """Reopen an image claimed with claim_image() that was never delivered.
+
+    Claims made with the fair-share strategy also give back the served image charged to the
+    image's Group B, in the same transaction.
+    """
+    try:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT source_group_b_id FROM images WHERE image_id = ?", (image_id,)).fetchone()
+            if not row:
+                conn.rollback()
+                logger.warning(f"Image ID {image_id} not found")
+                return False
+
+            conn.execute("UPDATE images SET status = 'open' WHERE image_id = ?", (image_id,))
+            if strategy == CLAIM_FAIR_SHARE:
+                _share_dispatcher.unrecord(conn, row[0], group_b_percentages)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            _share_dispatcher.invalidate()
+            raise
+        _open_images.add(image_id, row[0])
+        image_cache.update(image_id, status='open')
+        logger.info(f"Released claimed image {image_id} (strategy={strategy})")
+        return True
+    except Exception as e:
+        logger.error(f"Error releasing claimed image: {e}")
+        return False
+
+def get_all_images() -> List[Dict]:
+    """Get all images from the database."""
+    try:
+        return [image.to_dict() for image in iter_images()]
     except Exception as e:
         logger.error(f"Error getting all images: {e}")
         return []
@@ -212,66 +1456,50 @@ def get_all_images() -> List[Dict]:
 def get_image_by_id(image_id: str) -> Optional[Dict]:
     """Get an image by ID."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE image_id = ?", (image_id,))
-        else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images WHERE image_id = ?", (image_id,))
+        image = image_cache.get(image_id)
+        if image is not None:
+            return image
         
-        row = cursor.fetchone()
+        conn = get_connection()
+        row = conn.execute(f"SELECT {IMAGE_COLUMNS}, source_group_b_id FROM images WHERE image_id = ?", (image_id,)).fetchone()
         
         if not row:
             logger.warning(f"Image ID {image_id} not found")
-            conn.close()
             return None
         
-        image = {
-            'image_id': row[0],
-            'number': row[1],
-            'file_id': row[2],
-            'status': row[3]
-        }
-        
-        # Add metadata if available
-        if 'metadata' in columns and len(row) > 4 and row[4]:
-            try:
-                image['metadata'] = json.loads(row[4])
-                logger.info(f"Retrieved metadata for image {image_id}: {image['metadata']}")
-            except (ValueError, TypeError, json.JSONDecodeError) as e:
-                logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                image['metadata'] = {}
-        
-        conn.close()
+        image = _row_to_image(row)
+        image_cache.put(image, row[5])
+        if 'metadata' in image:
+            logger.info(f"Retrieved metadata for image {image_id}: {image['metadata']}")
         return image
     except Exception as e:
         logger.error(f"Error getting image by ID: {e}")
         return None
 
-def count_images_by_status() -> Tuple[int, int]:
-    """Count the number of open and closed images."""
+def inventory_snapshot() -> Dict:
+    """Get image counts overall and per source Group B from the materialised counters."""
+    snapshot = {'open': 0, 'closed': 0, 'total': 0, 'by_group_b': {}}
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT COUNT(*) FROM images WHERE status = 'open'")
-        open_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM images WHERE status = 'closed'")
-        closed_count = cursor.fetchone()[0]
-        
-        conn.close()
-        return open_count, closed_count
+        conn = get_connection()
+        for group_key, status, count in conn.execute("SELECT group_key, status, count FROM image_counts WHERE count != 0"):
+            group_b_id = None if group_key == UNGROUPED_KEY else group_key
+            group = snapshot['by_group_b'].setdefault(group_b_id, {'open': 0, 'closed': 0, 'total': 0})
+            group[status] = group.get(status, 0) + count
+            group['total'] += count
+            snapshot[status] = snapshot.get(status, 0) + count
+            snapshot['total'] += count
     except Exception as e:
-        logger.error(f"Error counting images by status: {e}")
-        return 0, 0
+        logger.error(f"Error reading inventory counters: {e}")
+    return snapshot
+
+def has_images() -> bool:
+    """Check whether the database holds any image at all."""
+    return inventory_snapshot()['total'] > 0
+
+def count_images_by_status() -> Tuple[int, int]:
+    """Count the number of open and closed images."""
+    snapshot = inventory_snapshot()
+    return snapshot['open'], snapshot['closed']
 
 def get_image_path(image_id: str) -> Optional[str]:
     """Get the path to an image file (for backward compatibility)."""
@@ -290,14 +1518,14 @@ def get_image_path(image_id: str) -> Optional[str]:
 def reset_all_image_statuses() -> bool:
     """Reset all image statuses to open."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
         
         cursor.execute("UPDATE images SET status = 'open'")
         
         conn.commit()
-        conn.close()
+        _open_images.invalidate()
+        image_cache.set_all_status('open')
         logger.info("Reset all image statuses to 'open'")
         return True
     except Exception as e:
@@ -307,14 +1535,14 @@ def reset_all_image_statuses() -> bool:
 def clear_all_images():
     """Delete all images from the database."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
         
         cursor.execute("DELETE FROM images")
         
         conn.commit()
-        conn.close()
+        _open_images.invalidate()
+        image_cache.clear()
         logger.info("All images deleted from database")
         return True
     except Exception as e:
@@ -325,32 +1553,28 @@ def update_image_metadata(image_id: str, metadata: str) -> bool:
     """Update an image's metadata."""
     logger.info(f"Updating metadata for image {image_id}: {metadata}")
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
+        conn = get_connection()
         cursor = conn.cursor()
         
         # Check if image exists
-        cursor.execute("SELECT image_id FROM images WHERE image_id = ?", (image_id,))
-        if not cursor.fetchone():
+        cursor.execute("SELECT number, file_id, status FROM images WHERE image_id = ?", (image_id,))
+        row = cursor.fetchone()
+        if not row:
             logger.warning(f"Image ID {image_id} not found")
-            conn.close()
             return False
         
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        has_metadata = any(col[1] == 'metadata' for col in cursor.fetchall())
-        
-        # Add metadata column if it doesn't exist
-        if not has_metadata:
-            cursor.execute("ALTER TABLE images ADD COLUMN metadata TEXT")
-            conn.commit()
-            logger.info("Added metadata column to images table")
-        
-        # Update metadata
-        cursor.execute("UPDATE images SET metadata = ? WHERE image_id = ?", (metadata, image_id))
+        # Update metadata and the indexed group columns derived from it
+        source_group_b_id, target_group_a_id = _group_ids_from_metadata(metadata)
+        cursor.execute(
+            "UPDATE images SET metadata = ?, source_group_b_id = ?, target_group_a_id = ? WHERE image_id = ?",
+            (metadata, source_group_b_id, target_group_a_id, image_id)
+        )
         
         conn.commit()
-        conn.close()
+        if row[2] == 'open':
+            _open_images.add(image_id, source_group_b_id)  # Re-files it under its new Group B
+        # Written through so the read-back (e.g. get_group_b_for_image) is served from the cache
+        image_cache.put_metadata(_row_to_image((image_id, row[0], row[1], row[2], metadata)), source_group_b_id)
         logger.info(f"Updated metadata for image {image_id}")
         return True
     except Exception as e:
@@ -360,383 +1584,417 @@ def update_image_metadata(image_id: str, metadata: str) -> bool:
 def get_random_open_image_by_group_b(group_b_id: int) -> Optional[Dict]:
     """Get a random open image that belongs to a specific Group B."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'metadata' not in columns:
-            logger.warning("Cannot filter by group_b_id as metadata column does not exist")
-            conn.close()
-            return get_random_open_image()  # Fall back to regular random selection
-        
-        # Get all open images first
-        cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE status = 'open'")
-        
-        rows = cursor.fetchall()
-        
-        if not rows:
-            logger.info("No open images available")
-            conn.close()
-            return None
-        
-        # Filter images by Group B ID
-        filtered_rows = []
-        for row in rows:
-            if row[4]:  # If metadata exists
-                try:
-                    metadata = json.loads(row[4])
-                    if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                        if int(metadata['source_group_b_id']) == int(group_b_id):
-                            filtered_rows.append(row)
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error processing metadata for image {row[0]}: {e}")
+        conn = get_connection()
+        row = _sample_open_image_row(conn, int(group_b_id))
         
         # If we found matching images, pick a random one
-        if filtered_rows:
-            logger.info(f"Found {len(filtered_rows)} open images for Group B ID {group_b_id}")
-            row = random.choice(filtered_rows)
-            
-            image = {
-                'image_id': row[0],
-                'number': row[1],
-                'file_id': row[2],
-                'status': row[3]
-            }
-            
-            if row[4]:
-                try:
-                    image['metadata'] = json.loads(row[4])
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                    image['metadata'] = {}
-            
-            conn.close()
-            return image
+        if row:
+            logger.info(f"Found {_open_images.count(conn, int(group_b_id))} open images for Group B ID {group_b_id}")
+            return _row_to_image(row)
         else:
             # If no matching images, fall back to any open image
             logger.info(f"No open images found for Group B ID {group_b_id}, falling back to any open image")
-            conn.close()
             return get_random_open_image() 
     except Exception as e:
         logger.error(f"Error in get_random_open_image_by_group_b: {e}")
         return get_random_open_image()  # Fall back to any open image on error 
 
-def clear_images_by_group_b(group_b_id: int):
-    """Delete images associated with a specific Group B from the database."""
+def count_images_by_group_b(group_b_id: int) -> int:
+    """Count the images associated with a specific Group B."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'metadata' not in columns:
-            logger.warning("Cannot filter by group_b_id as metadata column does not exist")
-            conn.close()
-            return False
-        
-        # First count total images
-        cursor.execute("SELECT COUNT(*) FROM images")
-        total_count = cursor.fetchone()[0]
-        logger.info(f"Total images in database before deletion: {total_count}")
-        
-        # Get all images first
-        cursor.execute("SELECT image_id, metadata FROM images")
-        rows = cursor.fetchall()
-        
-        if not rows:
-            logger.info("No images available to clear")
-            conn.close()
-            return True
-        
-        # Find images to delete by checking their metadata
-        images_to_delete = []
-        for row in rows:
-            image_id, metadata_str = row
-            if metadata_str:
-                try:
-                    metadata = json.loads(metadata_str)
-                    if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                        source_id = int(metadata['source_group_b_id'])
-                        target_id = int(group_b_id)
-                        logger.info(f"Comparing metadata Group B ID {source_id} with target {target_id}")
-                        if source_id == target_id:
-                            images_to_delete.append(image_id)
-                            logger.info(f"Will delete image {image_id}")
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error processing metadata for image {image_id}: {e}")
-            else:
-                logger.info(f"Image {image_id} has no metadata")
-        
-        # Delete the matching images
-        if images_to_delete:
-            placeholders = ', '.join(['?'] * len(images_to_delete))
-            cursor.execute(f"DELETE FROM images WHERE image_id IN ({placeholders})", images_to_delete)
-            conn.commit()
-            
-            # Verify deletion by counting remaining images
-            cursor.execute("SELECT COUNT(*) FROM images")
-            remaining_count = cursor.fetchone()[0]
-            deleted_count = total_count - remaining_count
-            
-            logger.info(f"Database had {total_count} images, deleted {deleted_count}, {remaining_count} remaining")
-            logger.info(f"Deleted {len(images_to_delete)} images for Group B ID {group_b_id}")
-        else:
-            logger.info(f"No images found for Group B ID {group_b_id}")
-        
-        conn.close()
-        return True
+        conn = get_connection()
+        row = conn.execute(
+            "SELECT COALESCE(SUM(count), 0) FROM image_counts WHERE group_key = ?", (int(group_b_id),)
+        ).fetchone()
+        return row[0]
     except Exception as e:
-        logger.error(f"Database error in clear_images_by_group_b: {e}")
-        return False 
+        logger.error(f"Error counting images for Group B {group_b_id}: {e}")
+        return 0
+
+def _reset_images(where: str, params: Tuple, on_delete=None) -> Optional[int]:
+    """Delete the images matching an indexed WHERE clause in one transaction.
+    
+    on_delete(conn, image_ids) runs inside the same transaction so callers can drop state tied
+    to the deleted images; if it raises, nothing is deleted. Returns the deleted row count, or
+    None on error.
+    """
+    conn = get_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        image_ids = [row[0] for row in conn.execute(f"SELECT image_id FROM images WHERE {where}", params)]
+        deleted = conn.execute(f"DELETE FROM images WHERE {where}", params).rowcount
+        if on_delete is not None:
+            on_delete(conn, image_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    for image_id in image_ids:
+        _open_images.discard(image_id)
+        image_cache.discard(image_id)
+    return deleted
+
+def reset_group_b_images(group_b_id: int, on_delete=None) -> Optional[int]:
+    """Delete every image of a Group B and return how many were deleted (None on error)."""
+    try:
+        deleted = _reset_images("source_group_b_id = ?", (int(group_b_id),), on_delete)
+        logger.info(f"Deleted {deleted} images for Group B ID {group_b_id}")
+        return deleted
+    except Exception as e:
+        logger.error(f"Database error in reset_group_b_images: {e}")
+        return None
+
+def reset_number_images(group_b_id: int, number: int, on_delete=None) -> Optional[int]:
+    """Delete the images with a number in a Group B and return how many were deleted (None on error)."""
+    try:
+        deleted = _reset_images("source_group_b_id = ? AND number = ?", (int(group_b_id), number), on_delete)
+        logger.info(f"Deleted {deleted} images with number {number} for Group B ID {group_b_id}")
+        return deleted
+    except Exception as e:
+        logger.error(f"Database error in reset_number_images: {e}")
+        return None
+
+def clear_images_by_group_b(group_b_id: int):
+    """Delete images associated with a specific Group B from the database."""
+    return reset_group_b_images(group_b_id) is not None
 
 def delete_image_by_number(number: int, group_b_id: int) -> bool:
     """Delete a specific image by its number from the database."""
+    return bool(reset_number_images(group_b_id, number))
+
+def get_next_open_images(limit: int = 1, after: Optional[Tuple[int, str]] = None, group_b_id: Optional[int] = None) -> List[Dict]:
+    """Get up to `limit` open images in ascending number order, starting after an
+    optional (number, image_id) cursor and optionally limited to a Group B."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'metadata' not in columns:
-            logger.warning("Cannot filter by group_b_id as metadata column does not exist")
-            conn.close()
-            return False
-        
-        # Get all images matching this number
-        cursor.execute("SELECT image_id, metadata FROM images WHERE number = ?", (number,))
-        rows = cursor.fetchall()
-        
-        if not rows:
-            logger.info(f"No images found with number {number}")
-            conn.close()
-            return False
-        
-        # Find images to delete by checking their metadata for matching Group B ID
-        images_to_delete = []
-        for row in rows:
-            image_id, metadata_str = row
-            if metadata_str:
-                try:
-                    metadata = json.loads(metadata_str)
-                    if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                        source_id = int(metadata['source_group_b_id'])
-                        target_id = int(group_b_id)
-                        logger.info(f"Comparing metadata Group B ID {source_id} with target {target_id}")
-                        if source_id == target_id:
-                            images_to_delete.append(image_id)
-                            logger.info(f"Will delete image {image_id} with number {number}")
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error processing metadata for image {image_id}: {e}")
-            else:
-                logger.info(f"Image {image_id} has no metadata")
-        
-        # Delete the matching images
-        if images_to_delete:
-            placeholders = ', '.join(['?'] * len(images_to_delete))
-            cursor.execute(f"DELETE FROM images WHERE image_id IN ({placeholders})", images_to_delete)
-            conn.commit()
-            
-            logger.info(f"Deleted {len(images_to_delete)} images with number {number} for Group B ID {group_b_id}")
-            conn.close()
-            return True
-        else:
-            logger.info(f"No matching images found with number {number} for Group B ID {group_b_id}")
-            conn.close()
-            return False
+        conn = get_connection()
+        where = "status = 'open'"
+        params: List = []
+        if group_b_id is not None:
+            where += " AND source_group_b_id = ?"
+            params.append(int(group_b_id))
+        if after is not None:
+            where += " AND (number, image_id) > (?, ?)"
+            params.extend(after)
+        params.append(limit)
+        
+        rows = conn.execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images WHERE {where} ORDER BY number ASC, image_id ASC LIMIT ?",
+            params
+        ).fetchall()
+        return [_row_to_image(row) for row in rows]
     except Exception as e:
-        logger.error(f"Database error in delete_image_by_number: {e}")
-        return False 
+        logger.error(f"Error getting next open images in ascending order: {e}")
+        return []
+
+def iter_open_images_ascending(batch_size: int = 100, group_b_id: Optional[int] = None):
+    """Lazily yield open images in ascending number order, fetching one keyset page at a time."""
+    after = None
+    while True:
+        images = get_next_open_images(batch_size, after, group_b_id)
+        for image in images:
+            yield image
+        if len(images) < batch_size:
+            return
+        after = (images[-1]['number'], images[-1]['image_id'])
 
 def get_next_open_image_ascending() -> Optional[Dict]:
     """Get the next open image in ascending order by number."""
+    images = get_next_open_images(1)
+    if not images:
+        logger.info("No open images available")
+        return None
+    
+    # The first image has the lowest number
+    return images[0]
+
+def get_next_open_image_ascending_with_percentage(group_b_percentages: Dict = None) -> Optional[Dict]:
+    """Get the next open image in ascending order by number, with the source Group B
+    chosen in proportion to its percentage (unlisted Group Bs weigh 100)."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
+        conn = get_connection()
         
-        if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE status = 'open' ORDER BY number ASC")
-        else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images WHERE status = 'open' ORDER BY number ASC")
-        
-        rows = cursor.fetchall()
+        # If no percentage settings, return first image
+        if not group_b_percentages:
+            return get_next_open_image_ascending()
         
-        if not rows:
+        row = _select_weighted_open_image_row(conn, group_b_percentages)
+        if not row:
             logger.info("No open images available")
-            conn.close()
             return None
         
-        # Get the first image (lowest number)
-        row = rows[0]
-        
-        image = {
-            'image_id': row[0],
-            'number': row[1],
-            'file_id': row[2],
-            'status': row[3]
-        }
-        
-        # Add metadata if available
-        if 'metadata' in columns and len(row) > 4 and row[4]:
-            try:
-                image['metadata'] = json.loads(row[4])
-            except (ValueError, TypeError, json.JSONDecodeError) as e:
-                logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                image['metadata'] = {}
-        
-        conn.close()
+        image = _row_to_image(row)
+        image.setdefault('metadata', {})
+        logger.info(f"Selected image {image['image_id']} by Group B percentage")
         return image
     except Exception as e:
-        logger.error(f"Error getting next open image in ascending order: {e}")
-        return None 
+        logger.error(f"Error getting next open image with percentage: {e}")
+        return None
+
+def _optional_int(value) -> Optional[int]:
+    """Coerce a stored chat/message ID to int for an indexed column, or None."""
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+def _epoch_from_iso(value, default: float) -> float:
+    """Epoch seconds of an ISO local time, or default if it is missing or malformed."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+def save_forwarded_msg(image_id: str, data: Dict, conn: Optional[sqlite3.Connection] = None,
+                       updated_at: Optional[float] = None) -> bool:
+    """Insert or replace the forwarded message mapping of an image, written at updated_at (default now)."""
+    try:
+        own_conn = conn is None
+        conn = conn or get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO forwarded_msgs "
+            "(image_id, group_a_chat_id, group_a_msg_id, group_b_chat_id, group_b_msg_id, number, data, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (image_id, _optional_int(data.get('group_a_chat_id')), _optional_int(data.get('group_a_msg_id')),
+             _optional_int(data.get('group_b_chat_id')), _optional_int(data.get('group_b_msg_id')),
+             None if data.get('number') is None else str(data.get('number')), json.dumps(data),
+             time.time() if updated_at is None else updated_at)
+        )
+        if own_conn:
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error saving forwarded message for image {image_id}: {e}")
+        return False
 
-def get_next_open_image_ascending_with_percentage(group_b_percentages: Dict = None) -> Optional[Dict]:
-    """Get the next open image in ascending order by number, considering Group B percentages as priority."""
+def save_group_b_response(image_id: str, response: str, conn: Optional[sqlite3.Connection] = None,
+                          updated_at: Optional[float] = None) -> bool:
+    """Insert or replace the Group B response recorded for an image, written at updated_at (default now)."""
     try:
-        init_db()  # Make sure the database exists
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # Check if metadata column exists
-        cursor.execute("PRAGMA table_info(images)")
-        columns = [col[1] for col in cursor.fetchall()]
-        
-        if 'metadata' in columns:
-            cursor.execute("SELECT image_id, number, file_id, status, metadata FROM images WHERE status = 'open' ORDER BY number ASC")
-        else:
-            cursor.execute("SELECT image_id, number, file_id, status FROM images WHERE status = 'open' ORDER BY number ASC")
-        
-        rows = cursor.fetchall()
-        
-        if not rows:
-            logger.info("No open images available")
-            conn.close()
-            return None
-        
-        # If no percentage settings, return first image
-        if not group_b_percentages:
-            row = rows[0]
-            image = {
-                'image_id': row[0],
-                'number': row[1],
-                'file_id': row[2],
-                'status': row[3]
-            }
-            
-            # Add metadata if available
-            if 'metadata' in columns and len(row) > 4 and row[4]:
-                try:
-                    image['metadata'] = json.loads(row[4])
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                    image['metadata'] = {}
-            
-            conn.close()
-            return image
-        
-        # PRIORITY SYSTEM: First, try to find images from 100% Group Bs (highest priority)
-        priority_images = []
-        high_percentage_images = []
-        normal_images = []
-        
-        for row in rows:
-            image = {
-                'image_id': row[0],
-                'number': row[1],
-                'file_id': row[2],
-                'status': row[3]
-            }
-            
-            # Add metadata if available
-            if 'metadata' in columns and len(row) > 4 and row[4]:
-                try:
-                    image['metadata'] = json.loads(row[4])
-                except (ValueError, TypeError, json.JSONDecodeError) as e:
-                    logger.error(f"Error parsing metadata for image {row[0]}: {e}")
-                    image['metadata'] = {}
-            else:
-                image['metadata'] = {}
-            
-            # Check if this image has Group B metadata
-            metadata = image.get('metadata', {})
-            if isinstance(metadata, dict) and 'source_group_b_id' in metadata:
-                try:
-                    source_group_b_id = int(metadata['source_group_b_id'])
-                    
-                    # Check percentage setting for this Group B
-                    if source_group_b_id in group_b_percentages:
-                        percentage = group_b_percentages[source_group_b_id]
-                        
-                        if percentage == 100:
-                            # 100% = Highest priority - these should be sent first
-                            priority_images.append(image)
-                            logger.info(f"Image {image['image_id']} from Group B {source_group_b_id} has 100% priority")
-                        elif percentage >= 50:
-                            # High percentage images
-                            high_percentage_images.append((image, percentage))
-                        else:
-                            # Lower percentage images
-                            normal_images.append((image, percentage))
-                    else:
-                        # No specific percentage setting, treat as normal
-                        normal_images.append((image, 100))  # Default 100% if not specified
-                        
-                except (ValueError, TypeError) as e:
-                    logger.error(f"Error processing metadata for image {row[0]}: {e}")
-                    normal_images.append((image, 100))  # Default if error
-            else:
-                # No metadata or no Group B ID, treat as normal
-                normal_images.append((image, 100))  # Default 100%
-        
-        # Return images by priority:
-        # 1. First, return any 100% priority images (in ascending order)
-        if priority_images:
-            selected_image = priority_images[0]  # Already sorted by number ASC
-            logger.info(f"Selected priority image: {selected_image['image_id']} (100% priority)")
-            conn.close()
-            return selected_image
-        
-        # 2. Then try high percentage images (with chance)
-        if high_percentage_images:
-            import random
-            for image, percentage in high_percentage_images:
-                random_chance = random.randint(1, 100)
-                logger.info(f"Image {image['image_id']} has {percentage}% chance, rolled {random_chance}")
-                if random_chance <= percentage:
-                    logger.info(f"Selected high percentage image: {image['image_id']}")
-                    conn.close()
-                    return image
-        
-        # 3. Finally try normal/lower percentage images
-        if normal_images:
-            import random
-            for image, percentage in normal_images:
-                random_chance = random.randint(1, 100)
-                logger.info(f"Image {image['image_id']} has {percentage}% chance, rolled {random_chance}")
-                if random_chance <= percentage:
-                    logger.info(f"Selected normal image: {image['image_id']}")
-                    conn.close()
-                    return image
-        
-        # If we get here, all images were skipped due to percentage, return None
-        logger.info("All open images were skipped due to percentage restrictions")
-        conn.close()
+        own_conn = conn is None
+        conn = conn or get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO group_b_responses (image_id, response, updated_at) VALUES (?, ?, ?)",
+            (image_id, response, time.time() if updated_at is None else updated_at)
+        )
+        if own_conn:
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error saving Group B response for image {image_id}: {e}")
+        return False
+
+def delete_image_message_state(image_ids: List[str], conn: Optional[sqlite3.Connection] = None) -> int:
+    """Delete the forwarded mappings and Group B responses of images, returning the mappings deleted.
+    
+    Pass the connection of an open transaction (e.g. from a reset on_delete hook) to make this part
+    of it; otherwise the deletes are committed here.
+    """
+    own_conn = conn is None
+    conn = conn or get_connection()
+    deleted = 0
+    for start in range(0, len(image_ids), 500):
+        chunk = list(image_ids[start:start + 500])
+        placeholders = ', '.join(['?'] * len(chunk))
+        deleted += conn.execute(f"DELETE FROM forwarded_msgs WHERE image_id IN ({placeholders})", chunk).rowcount
+        conn.execute(f"DELETE FROM group_b_responses WHERE image_id IN ({placeholders})", chunk)
+    if own_conn:
+        conn.commit()
+    return deleted
+
+def save_pending_custom_amount(message_id: int, data: Dict, conn: Optional[sqlite3.Connection] = None,
+                               updated_at: Optional[float] = None) -> bool:
+    """Insert or replace a pending custom amount approval keyed by its Group B message ID.
+    
+    updated_at defaults to the submission time in data['timestamp'], else now.
+    """
+    try:
+        own_conn = conn is None
+        conn = conn or get_connection()
+        if updated_at is None:
+            updated_at = _epoch_from_iso(data.get('timestamp'), time.time())
+        conn.execute(
+            "INSERT OR REPLACE INTO pending_custom_amounts "
+            "(message_id, img_id, responder, reply_to_msg_id, data, timestamp, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (int(message_id), data.get('img_id'), _optional_int(data.get('responder')),
+             _optional_int(data.get('reply_to_msg_id')), json.dumps(data), data.get('timestamp'), updated_at)
+        )
+        if own_conn:
+            conn.commit()
+        return True
+    except Exception as e:
+        logger.error(f"Error saving pending custom amount {message_id}: {e}")
+        return False
+
+def delete_pending_custom_amount(message_id: int) -> bool:
+    """Delete a pending custom amount approval."""
+    try:
+        conn = get_connection()
+        with conn:
+            cursor = conn.execute("DELETE FROM pending_custom_amounts WHERE message_id = ?", (int(message_id),))
+        return cursor.rowcount > 0
+    except Exception as e:
+        logger.error(f"Error deleting pending custom amount {message_id}: {e}")
+        return False
+
+def import_message_state(forwarded: Dict[str, Dict], responses: Dict[str, str], pending: Dict) -> bool:
+    """Bulk-load message state (e.g. from the legacy JSON files) in one transaction."""
+    try:
+        conn = get_connection()
+        with conn:
+            for image_id, data in forwarded.items():
+                if not save_forwarded_msg(image_id, data, conn):
+                    raise sqlite3.DatabaseError(f"could not import forwarded message {image_id}")
+            for image_id, response in responses.items():
+                if not save_group_b_response(image_id, response, conn):
+                    raise sqlite3.DatabaseError(f"could not import Group B response {image_id}")
+            for message_id, data in pending.items():
+                if not save_pending_custom_amount(message_id, data, conn):
+                    raise sqlite3.DatabaseError(f"could not import pending custom amount {message_id}")
+        logger.info(f"Imported {len(forwarded)} forwarded messages, {len(responses)} Group B responses "
+                    f"and {len(pending)} pending custom amounts")
+        return True
+    except Exception as e:
+        logger.error(f"Error importing message state: {e}")
+        return False
+
+# Hot message-state tables: namespace -> (table, key column, value column, write-time column)
+MESSAGE_STATE_TABLES = {
+    'forwarded_msgs': ('forwarded_msgs', 'image_id', 'data', 'updated_at'),
+    'group_b_responses': ('group_b_responses', 'image_id', 'response', 'updated_at'),
+    'pending_custom_amounts': ('pending_custom_amounts', 'message_id', 'data', 'updated_at'),
+}
+
+def load_message_state(namespace: str) -> List[Tuple]:
+    """Load the hot rows of a message-state namespace as (key, value, write time), oldest first."""
+    try:
+        table, key_column, value_column, time_column = MESSAGE_STATE_TABLES[namespace]
+        rows = get_connection().execute(
+            f"SELECT {key_column}, {value_column}, {time_column} FROM {table} ORDER BY {time_column}"
+        ).fetchall()
+        if value_column == 'data':
+            rows = [(key, json.loads(data), updated_at) for key, data, updated_at in rows]
+        return rows
+    except Exception as e:
+        logger.error(f"Error loading {namespace}: {e}")
+        return []
+
+def archive_message_state(namespace: str, items: List[Tuple], delete_hot: bool = True) -> int:
+    """Move evicted (key, value) entries of a message-state namespace to the archive.
+    
+    With delete_hot the matching rows are removed from the hot table in the same transaction.
+    Returns how many entries were archived (0 on error).
+    """
+    try:
+        conn = get_connection()
+        table, key_column, _, _ = MESSAGE_STATE_TABLES[namespace]
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "INSERT INTO archived_state (namespace, key, data, archived_at) VALUES (?, ?, ?, ?)",
+                [(namespace, str(key), json.dumps(value), now) for key, value in items]
+            )
+            if delete_hot:
+                conn.executemany(f"DELETE FROM {table} WHERE {key_column} = ?", [(key,) for key, _ in items])
+        return len(items)
+    except Exception as e:
+        logger.error(f"Error archiving {len(items)} {namespace} entries: {e}")
+        return 0
+
+def expire_message_state(namespace: str, max_age_seconds: float) -> int:
+    """Archive the hot rows of a namespace last written more than max_age_seconds ago."""
+    try:
+        conn = get_connection()
+        table, key_column, value_column, time_column = MESSAGE_STATE_TABLES[namespace]
+        cutoff = time.time() - max_age_seconds
+        
+        with conn:
+            rows = conn.execute(
+                f"SELECT {key_column}, {value_column} FROM {table} WHERE {time_column} < ?", (cutoff,)
+            ).fetchall()
+            if value_column == 'data':
+                rows = [(key, json.loads(data)) for key, data in rows]
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO archived_state (namespace, key, data, archived_at) VALUES (?, ?, ?, ?)",
+                [(namespace, str(key), json.dumps(value), now) for key, value in rows]
+            )
+            conn.execute(f"DELETE FROM {table} WHERE {time_column} < ?", (cutoff,))
+        
+        if rows:
+            logger.info(f"Archived {len(rows)} expired {namespace} entries")
+        return len(rows)
+    except Exception as e:
+        logger.error(f"Error expiring {namespace} entries: {e}")
+        return 0
+
+def get_archived_state(namespace: str, key):
+    """Get the most recently archived value of a message-state entry, or None."""
+    try:
+        row = get_connection().execute(
+            "SELECT data FROM archived_state WHERE namespace = ? AND key = ? ORDER BY id DESC LIMIT 1",
+            (namespace, str(key))
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    except Exception as e:
+        logger.error(f"Error getting archived {namespace} entry {key}: {e}")
         return None
+
+def load_config() -> Tuple[Dict, int]:
+    """Load every configuration key in one read, returning ({key: value}, config version)."""
+    try:
+        conn = get_connection()
+        with conn:
+            values = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM config")}
+            version = conn.execute("SELECT value FROM id_sequences WHERE name = 'config'").fetchone()
+        return values, version[0] if version else 0
+    except Exception as e:
+        logger.error(f"Error loading configuration: {e}")
+        return {}, 0
+
+def get_config_version() -> int:
+    """Get the configuration change counter (bumped by triggers on every change to the config table)."""
+    try:
+        row = get_connection().execute("SELECT value FROM id_sequences WHERE name = 'config'").fetchone()
+        return row[0] if row else 0
+    except Exception as e:
+        logger.error(f"Error getting configuration version: {e}")
+        return 0
+
+def save_config(values: Dict) -> Optional[Tuple[int, int]]:
+    """Atomically store the given configuration keys whose value changed.
+
+    Only the keys passed are written; unchanged ones are not rewritten and do not bump the version
+    (the config table's triggers do). Returns (version before, version after), so callers can tell
+    whether someone else committed in between, or None on error.
+    """
+    try:
+        conn = get_connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            stored = dict(conn.execute("SELECT key, value FROM config"))
+            changed = []
+            for key, value in values.items():
+                encoded = json.dumps(value, sort_keys=True)
+                if stored.get(key) != encoded:
+                    changed.append((key, encoded))
+            
+            previous = conn.execute("SELECT value FROM id_sequences WHERE name = 'config'").fetchone()[0]
+            if changed:
+                now = time.time()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO config (key, value, version, updated_at) VALUES (?, ?, ?, ?)",
+                    [(key, encoded, previous + 1, now) for key, encoded in changed]
+                )
+            version = conn.execute("SELECT value FROM id_sequences WHERE name = 'config'").fetchone()[0]
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
         
+        if changed:
+            logger.info(f"Saved configuration version {version}: {', '.join(key for key, _ in changed)}")
+        return previous, version
     except Exception as e:
-        logger.error(f"Error getting next open image with percentage: {e}")
-        return None 
\ No newline at end of file
+        logger.error(f"Error saving configuration: {e}")
+        return None
@@ -0,0 +1,273 @@
+import copy
+import json
+import os
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# fsync the journal at most this often; appends in between share one fsync
+JOURNAL_FSYNC_INTERVAL = 0.05
+# ...or as soon as this many records are waiting
+JOURNAL_FSYNC_BATCH = 64
+# Rewrite the snapshot once the journal grows past this many bytes
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+# How often the compactor checks the journal size
+JOURNAL_COMPACT_CHECK_SECONDS = 30.0
+
+_MISSING = object()
+
+class StateJournal:
+    """Append-only JSONL journal of key/value mutations over a JSON snapshot.
+
+    State is a set of namespaces, each a dict. set()/delete() append one compact record and
+    return once it is written; a flusher thread fsyncs batches of records. Startup replays the
+    journal over the last snapshot, and a compactor thread rewrites the snapshot (and starts a new
+    journal) once the journal passes JOURNAL_COMPACT_BYTES.
+
+    Every record carries a sequence number and the snapshot stores the last one it includes, so a
+    crash at any point of a compaction replays each record exactly once. A set may also carry the
+    entry's write time, which is kept through replay and compaction and returned by items().
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: str,
+                 fsync_interval: float = JOURNAL_FSYNC_INTERVAL,
+                 fsync_batch: int = JOURNAL_FSYNC_BATCH,
+                 compact_bytes: int = JOURNAL_COMPACT_BYTES):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.rotated_path = f"{journal_path}.1"
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.compact_bytes = compact_bytes
+
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._state: Dict[str, Dict] = {}
+        self._stamps: Dict[str, Dict] = {}
+        self._seq = 0
+        self._file = None
+        self._unsynced = 0
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+        self.stats = {'appends': 0, 'fsyncs': 0, 'compactions': 0, 'replayed': 0}
+
+    def load(self) -> None:
+        """Replay snapshot plus journal, open the journal for appends and start the background threads."""
+        with self._lock:
+            if self._file is not None:
+                return
+            self._state, self._stamps, snapshot_seq = self._read_snapshot()
+            self._seq = snapshot_seq
+            for path in (self.rotated_path, self.journal_path):
+                self._replay(path, snapshot_seq)
+
+            self._file = open(self.journal_path, 'a', encoding='utf-8')
+            # Terminate a torn final line so the next record does not get glued onto it
+            if self._file.tell() and not _ends_with_newline(self.journal_path):
+                self._file.write('\n')
+            logger.info(f"Loaded journal state: {sum(len(v) for v in self._state.values())} keys, "
+                        f"{self.stats['replayed']} records replayed, seq {self._seq}")
+
+        # A compaction interrupted after rotating the journal is finished now
+        if os.path.exists(self.rotated_path):
+            self.compact()
+
+        for target, name in ((self._flush_loop, "journal-fsync"), (self._compact_loop, "journal-compactor")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _read_snapshot(self):
+        """Read the snapshot file, returning (state, write times, last sequence number it includes)."""
+        if not os.path.exists(self.snapshot_path):
+            return {}, {}, 0
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            # Namespaces are stored as [key, value] or [key, value, write_time] lists so integer
+            # keys survive the round trip
+            state, stamps = {}, {}
+            for ns, items in snapshot.get('state', {}).items():
+                state[ns] = {_key(item[0]): item[1] for item in items}
+                stamps[ns] = {_key(item[0]): item[2] for item in items if len(item) > 2}
+            return state, stamps, snapshot.get('seq', 0)
+        except Exception as e:
+            logger.error(f"Error reading journal snapshot {self.snapshot_path}: {e}")
+            return {}, {}, 0
+
+    def _replay(self, path: str, snapshot_seq: int) -> None:
+        """Apply the records of one journal file that are newer than the snapshot."""
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-append; everything before it is intact
+                    logger.warning(f"Ignoring unreadable record at {path}:{line_number}")
+                    continue
+                if record['s'] <= snapshot_seq:
+                    continue
+                self._apply(record)
+                self._seq = max(self._seq, record['s'])
+                self.stats['replayed'] += 1
+
+    def _apply(self, record: Dict) -> None:
+        """Apply one journal record to the in-memory state."""
+        namespace = self._state.setdefault(record['n'], {})
+        stamps = self._stamps.setdefault(record['n'], {})
+        key = _key(record['k'])
+        if record['o'] == 'set':
+            namespace[key] = record['v']
+            if 't' in record:
+                stamps[key] = record['t']
+            else:
+                stamps.pop(key, None)
+        else:
+            namespace.pop(key, None)
+            stamps.pop(key, None)
+
+    def get(self, namespace: str, key, default=None) -> Any:
+        """Get a value from the state."""
+        with self._lock:
+            return self._state.get(namespace, {}).get(key, default)
+
+    def namespace(self, namespace: str) -> Dict:
+        """Get a copy of one namespace."""
+        with self._lock:
+            return copy.deepcopy(self._state.get(namespace, {}))
+
+    def items(self, namespace: str) -> List[Tuple[Any, Any, Optional[float]]]:
+        """Get a copy of one namespace as (key, value, write time or None) tuples."""
+        with self._lock:
+            stamps = self._stamps.get(namespace, {})
+            return [(key, copy.deepcopy(value), stamps.get(key))
+                    for key, value in self._state.get(namespace, {}).items()]
+
+    def set(self, namespace: str, key, value, stamp: Optional[float] = None) -> None:
+        """Set a key, optionally with its write time, appending a record unless nothing changed."""
+        with self._lock:
+            if (self._state.get(namespace, {}).get(key, _MISSING) == value and
+                    self._stamps.get(namespace, {}).get(key) == stamp):
+                return
+            # Keep a private copy so later in-place changes by the caller are not mistaken for no-ops
+            record = {'o': 'set', 'n': namespace, 'k': key, 'v': copy.deepcopy(value)}
+            if stamp is not None:
+                record['t'] = stamp
+            self._append(record)
+
+    def delete(self, namespace: str, key) -> None:
+        """Delete a key, appending a record if it exists."""
+        with self._lock:
+            if key not in self._state.get(namespace, {}):
+                return
+            self._append({'o': 'del', 'n': namespace, 'k': key})
+
+    def _append(self, record: Dict) -> None:
+        """Write one record to the journal and apply it (caller holds the lock)."""
+        if self._file is None:
+            raise RuntimeError("StateJournal.load() must be called before writing")
+        self._seq += 1
+        record['s'] = self._seq
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._apply(record)
+        self.stats['appends'] += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_batch:
+            self._sync()
+        else:
+            self._wake.set()
+
+    def _sync(self) -> None:
+        """Flush and fsync the journal (caller holds the lock)."""
+        if not self._unsynced or self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self.stats['fsyncs'] += 1
+
+    def sync(self) -> None:
+        """Make every record appended so far durable."""
+        with self._lock:
+            self._sync()
+
+    def _flush_loop(self) -> None:
+        """Group-commit appends: fsync at most once per fsync_interval."""
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Error syncing journal: {e}")
+
+    def _compact_loop(self) -> None:
+        """Compact whenever the journal outgrows compact_bytes."""
+        while not self._stop.wait(JOURNAL_COMPACT_CHECK_SECONDS):
+            try:
+                if os.path.getsize(self.journal_path) >= self.compact_bytes:
+                    self.compact()
+            except Exception as e:
+                logger.error(f"Error compacting journal: {e}")
+
+    def compact(self) -> None:
+        """Write a snapshot of the current state and drop the journal records it covers."""
+        with self._compact_lock:
+            with self._lock:
+                # Rotate so appends continue into a fresh journal while the snapshot is written
+                if not os.path.exists(self.rotated_path):
+                    self._sync()
+                    self._file.close()
+                    os.replace(self.journal_path, self.rotated_path)
+                    self._file = open(self.journal_path, 'a', encoding='utf-8')
+                seq = self._seq
+                snapshot = json.dumps({
+                    'seq': seq,
+                    'state': {ns: [_snapshot_item(key, value, self._stamps.get(ns, {}))
+                                   for key, value in values.items()]
+                              for ns, values in self._state.items()}
+                }, separators=(',', ':'))
+
+            temp_path = f"{self.snapshot_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.snapshot_path)
+            os.remove(self.rotated_path)
+            self.stats['compactions'] += 1
+            logger.info(f"Compacted journal into snapshot at seq {seq} ({len(snapshot)} bytes)")
+
+    def close(self) -> None:
+        """Stop the background threads and fsync outstanding records."""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+        logger.info(f"Closed state journal: {self.stats}")
+
+def _key(key):
+    """JSON turns tuple keys into lists; make them hashable again."""
+    return tuple(key) if isinstance(key, list) else key
+
+def _snapshot_item(key, value, stamps: Dict) -> List:
+    """A snapshot entry: [key, value], plus the write time when there is one."""
+    return [key, value] if key not in stamps else [key, value, stamps[key]]
+
+def _ends_with_newline(path: str) -> bool:
+    """Check whether a non-empty file ends with a newline."""
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
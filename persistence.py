@@ -0,0 +1,129 @@
+import atexit
+import json
+import os
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Changes marked within this window are written together
+PERSIST_DELAY_SECONDS = 0.5
+
+class PersistenceWriter:
+    """Debounced background writer for JSON state.
+
+    Each target is registered with a function returning its JSON-serializable content and
+    either a file path (written via a temp file and os.replace) or a write function. Callers
+    only mark targets dirty; one background thread waits PERSIST_DELAY_SECONDS after the first
+    change so a burst collapses into a single pass, then writes every dirty target (files only when
+    their content changed). close() (called after updater.idle() returns on SIGTERM/SIGINT) and interpreter
+    exit flush whatever is still pending.
+    """
+
+    def __init__(self, delay: float = PERSIST_DELAY_SECONDS):
+        self.delay = delay
+        self._files: Dict[str, Dict[str, Any]] = {}
+        self._dirty = set()
+        self._in_flight = set()  # Targets taken off _dirty by a flush that is still writing them
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'marks': 0, 'writes': 0, 'skipped': 0, 'errors': 0}
+
+    def register(self, path: str, serialize: Callable[[], Any], description: str,
+                 write: Optional[Callable[[Any], Any]] = None) -> None:
+        """Register a target and the function producing its content.
+
+        Without write, path is the JSON file to write; with it, path only names the target and
+        write(content) stores it (returning None signals failure). serialize runs on the writer
+        thread, so it must take whatever lock guards the state it reads.
+        """
+        self._files[path] = {'serialize': serialize, 'description': description, 'write': write, 'last': None}
+
+    def mark_dirty(self, *paths: str) -> None:
+        """Schedule targets (all registered targets if none are given) for the next write."""
+        with self._lock:
+            self._dirty.update(paths or self._files)
+            self.stats['marks'] += 1
+            if self._thread is None:
+                self._start()
+        self._wake.set()
+
+    @property
+    def pending(self) -> bool:
+        """Whether some marked changes have not been written yet (including ones being written now)."""
+        with self._lock:
+            return bool(self._dirty or self._in_flight)
+
+    def _start(self) -> None:
+        """Start the writer thread (caller holds the lock)."""
+        self._thread = threading.Thread(target=self._run, name="persistence-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self) -> None:
+        """Wait for changes, let the burst settle, then write."""
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            if self._stop.wait(self.delay):
+                break
+            self.flush()
+
+    def flush(self) -> None:
+        """Write every dirty target now."""
+        with self._write_lock:
+            with self._lock:
+                paths, self._dirty = self._dirty, set()
+                self._in_flight = set(paths)
+            for path in paths:
+                try:
+                    self._write(path)
+                except Exception as e:
+                    # Keep it dirty so the next pass (or close()) tries again
+                    logger.error(f"Error saving {self._files[path]['description']}: {e}")
+                    self.stats['errors'] += 1
+                    with self._lock:
+                        self._dirty.add(path)
+                finally:
+                    with self._lock:
+                        self._in_flight.discard(path)
+
+    def _write(self, path: str) -> None:
+        """Write one target, skipping a file whose content is unchanged since its last write."""
+        entry = self._files[path]
+        value = entry['serialize']()
+
+        if entry['write'] is not None:
+            # Not deduplicated here: the store behind it may have been changed by someone else
+            # since our last write, and write functions diff against it themselves
+            if entry['write'](value) is None:
+                raise IOError(f"writer for {path} reported failure")
+            self.stats['writes'] += 1
+            return
+
+        content = json.dumps(value, indent=2)
+        if content == entry['last']:
+            self.stats['skipped'] += 1
+            return
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        entry['last'] = content
+        self.stats['writes'] += 1
+        logger.info(f"Saved {entry['description']} to {path}")
+
+    def close(self) -> None:
+        """Stop the writer thread and flush pending changes."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
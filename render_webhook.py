@@ -96,6 +96,10 @@ def webhook():
     except Exception as e:
         print(f"❌ Error processing webhook: {e}")
         return "Error", 500
+    finally:
+        # Handlers ran on this request thread; release its database connection with it
+        import db
+        db.close_thread_connection()
 
 @app.route('/health', methods=['GET'])
 def health():
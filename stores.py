@@ -0,0 +1,349 @@
+import heapq
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+class BoundedStore(MutableMapping):
+    """Dict-like store with per-entry expiry and a size cap.
+
+    Entries are kept in write order; entries older than ttl_seconds are evicted first, then the
+    oldest live entries while there are more than max_entries, on the next write, len() or expire()
+    call. Subclasses whose live entries must never be dropped set evict_live = False, making
+    max_entries a soft cap. Evicted entries are passed to on_evict(name, [(key, value), ...]) so
+    they can be archived instead of lost. Iteration works on a snapshot, so handlers may iterate
+    while other threads write.
+    """
+    
+    # Whether live entries may be evicted to stay within max_entries
+    evict_live = True
+
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int,
+                 on_evict: Optional[Callable[[str, List[Tuple[Any, Any]]], None]] = None,
+                 clock: Callable[[], float] = time.time):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.clock = clock
+        self._data: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.stats = {'expired': 0, 'overflow': 0, 'over_cap': False}
+
+    def __getitem__(self, key):
+        with self._lock:
+            value, stamp = self._data[key]
+            if stamp < self.clock() - self.ttl_seconds:
+                raise KeyError(key)
+            return value
+
+    def __setitem__(self, key, value) -> None:
+        self.put(key, value)
+
+    def put(self, key, value) -> float:
+        """Set an entry and return its write time, for persisting alongside the value."""
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._unindex(key, old[0])
+            stamp = self.clock()
+            self._data[key] = (value, stamp)
+            self._index(key, value, stamp)
+            evicted = self._collect_evictions()
+        self._archive(evicted)
+        return stamp
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            value, _ = self._data.pop(key)
+            self._unindex(key, value)
+
+    def __contains__(self, key) -> bool:
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self) -> Iterator:
+        with self._lock:
+            cutoff = self.clock() - self.ttl_seconds
+            return iter([key for key, (_, stamp) in self._data.items() if stamp >= cutoff])
+
+    def __len__(self) -> int:
+        # Purge first so len() agrees with iteration, which skips expired entries
+        with self._lock:
+            evicted = self._collect_evictions()
+            size = len(self._data)
+        self._archive(evicted)
+        return size
+
+    def load(self, items, stamp: Optional[float] = None) -> None:
+        """Replace the contents with persisted state.
+
+        items are (key, value) or (key, value, write_time) tuples; entries without a write time
+        get stamp (default now). Entries already past the TTL are evicted and archived at once.
+        """
+        default = self.clock() if stamp is None else stamp
+        entries = []
+        for key, value, *rest in items:
+            entries.append((key, value, rest[0] if rest and rest[0] is not None else default))
+        # Keep write order so the oldest entries stay at the front
+        entries.sort(key=lambda entry: entry[2])
+        with self._lock:
+            self._data = OrderedDict((key, (value, written)) for key, value, written in entries)
+            self._reset_indexes()
+            for key, (value, written) in self._data.items():
+                self._index(key, value, written)
+            evicted = self._collect_evictions()
+        self._archive(evicted)
+
+    def expire(self) -> int:
+        """Evict expired and overflowing entries now, returning how many were evicted."""
+        with self._lock:
+            evicted = self._collect_evictions()
+        self._archive(evicted)
+        return len(evicted)
+
+    def _collect_evictions(self) -> List[Tuple[Any, Any]]:
+        """Pop expired entries, then overflowing live ones if allowed (caller holds the lock)."""
+        evicted = []
+        cutoff = self.clock() - self.ttl_seconds
+        # Write order means the oldest entries are always at the front
+        while self._data:
+            key, (value, stamp) = next(iter(self._data.items()))
+            if stamp >= cutoff and (len(self._data) <= self.max_entries or not self.evict_live):
+                break
+            self._data.popitem(last=False)
+            self._unindex(key, value)
+            evicted.append((key, value))
+            self.stats['expired' if stamp < cutoff else 'overflow'] += 1
+        
+        if len(self._data) > self.max_entries and not self.stats['over_cap']:
+            logger.warning(f"{self.name} holds {len(self._data)} live entries, over its cap of {self.max_entries}")
+        self.stats['over_cap'] = len(self._data) > self.max_entries
+        return evicted
+
+    # Subclasses maintain secondary indexes through these hooks (called with the lock held)
+    def _index(self, key, value, stamp: float) -> None:
+        pass
+
+    def _unindex(self, key, value) -> None:
+        pass
+
+    def _reset_indexes(self) -> None:
+        pass
+
+    def _archive(self, evicted: List[Tuple[Any, Any]]) -> None:
+        """Hand evicted entries to on_evict outside the lock."""
+        if not evicted or self.on_evict is None:
+            return
+        try:
+            self.on_evict(self.name, evicted)
+            logger.info(f"Archived {len(evicted)} entries evicted from {self.name}")
+        except Exception as e:
+            logger.error(f"Error archiving {len(evicted)} entries evicted from {self.name}: {e}")
+
+def _message_id(value) -> Optional[int]:
+    """Normalize a Telegram message ID stored as int or str."""
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+class PendingApprovalStore(BoundedStore):
+    """BoundedStore of pending custom amounts keyed by message_id, with secondary indexes.
+
+    Hash indexes cover original_msg_id, reply_to_msg_id, responder, img_id and amount, and a
+    heap ordered by submission time finds the newest entry, so every approval lookup is O(1) or
+    O(log n) instead of a scan over the backlog. Entries waiting for an admin are only ever
+    dropped by expiry, never to make room.
+    """
+    
+    evict_live = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reset_indexes()
+
+    def _reset_indexes(self) -> None:
+        self._by_original_msg: Dict[int, Set] = defaultdict(set)
+        self._by_reply_to_msg: Dict[int, Set] = defaultdict(set)
+        self._by_responder: Dict[Any, Set] = defaultdict(set)
+        self._by_image: Dict[str, Set] = defaultdict(set)
+        self._by_amount: Dict[str, Set] = defaultdict(set)
+        # Max-heap of (-submitted_at, key); entries of removed keys are skipped lazily
+        self._newest: List[Tuple[float, Any]] = []
+
+    def _index_entries(self, key, value):
+        """The (index, index key) pairs an entry is filed under."""
+        return (
+            (self._by_original_msg, _message_id(value.get('original_msg_id'))),
+            (self._by_reply_to_msg, _message_id(value.get('reply_to_msg_id'))),
+            (self._by_responder, value.get('responder')),
+            (self._by_image, value.get('img_id')),
+            (self._by_amount, None if value.get('amount') is None else str(value.get('amount'))),
+        )
+
+    def _index(self, key, value, stamp: float) -> None:
+        for index, index_key in self._index_entries(key, value):
+            if index_key is not None:
+                index[index_key].add(key)
+        heapq.heappush(self._newest, (-self._submitted_at(value, stamp), key))
+        # Drop stale heap entries once they outnumber live ones
+        if len(self._newest) > 2 * len(self._data) + 64:
+            self._newest = [(-self._submitted_at(v, s), k) for k, (v, s) in self._data.items()]
+            heapq.heapify(self._newest)
+
+    def _unindex(self, key, value) -> None:
+        for index, index_key in self._index_entries(key, value):
+            keys = index.get(index_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[index_key]
+
+    @staticmethod
+    def _submitted_at(value, stamp: float) -> float:
+        """Submission time of an entry from its ISO 'timestamp', else its write time."""
+        try:
+            return datetime.fromisoformat(value['timestamp']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return stamp
+
+    def _first_live(self, keys) -> Optional[Tuple[Any, Dict]]:
+        """Oldest unexpired (key, value) among candidate keys."""
+        for key in sorted(keys or ()):
+            value = self.get(key)
+            if value is not None:
+                return key, value
+        return None
+
+    def find_by_message(self, message_id) -> Optional[Tuple[Any, Dict]]:
+        """Find the pending entry for a Group B message: its own key, original or replied-to message."""
+        message_id = _message_id(message_id)
+        if message_id is None:
+            return None
+        with self._lock:
+            value = self.get(message_id)
+            if value is not None:
+                return message_id, value
+            return (self._first_live(self._by_original_msg.get(message_id)) or
+                    self._first_live(self._by_reply_to_msg.get(message_id)))
+
+    def find_by_amount(self, amount) -> Optional[Tuple[Any, Dict]]:
+        """Find the oldest pending entry for a custom amount."""
+        with self._lock:
+            return self._first_live(self._by_amount.get(str(amount)))
+
+    def keys_for_responder(self, responder) -> List:
+        """Keys of the pending entries submitted by a user."""
+        with self._lock:
+            return [key for key in self._by_responder.get(responder, ()) if key in self]
+
+    def keys_for_image(self, img_id: str) -> List:
+        """Keys of the pending entries for an image."""
+        with self._lock:
+            return [key for key in self._by_image.get(img_id, ()) if key in self]
+
+    def newest(self) -> Optional[Tuple[Any, Dict]]:
+        """The most recently submitted pending entry."""
+        with self._lock:
+            while self._newest:
+                submitted_at, key = self._newest[0]
+                entry = self._data.get(key)
+                if entry is not None and -submitted_at == self._submitted_at(*entry) and key in self:
+                    return key, entry[0]
+                heapq.heappop(self._newest)
+            return None
+
+class ForwardIndex(BoundedStore):
+    """BoundedStore of forwarded message mappings keyed by image_id, with reverse indexes.
+
+    Mappings can be found in O(1) by (group_b_chat_id, group_b_msg_id), (group_b_chat_id, number),
+    Group B chat and Group A chat, and a chat's mappings are removed without touching the rest.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reset_indexes()
+
+    def _reset_indexes(self) -> None:
+        self._by_group_b_msg: Dict[Tuple[int, int], Any] = {}
+        self._by_number: Dict[Tuple[int, str], Set] = defaultdict(set)
+        self._by_group_b_chat: Dict[int, Set] = defaultdict(set)
+        self._by_group_a_chat: Dict[int, Set] = defaultdict(set)
+
+    @staticmethod
+    def _chat_keys(value):
+        """(group_b_chat_id, group_b_msg_id, number, group_a_chat_id) normalized for indexing."""
+        number = value.get('number')
+        return (_message_id(value.get('group_b_chat_id')), _message_id(value.get('group_b_msg_id')),
+                None if number is None else str(number), _message_id(value.get('group_a_chat_id')))
+
+    def _index(self, key, value, stamp: float) -> None:
+        group_b_chat, group_b_msg, number, group_a_chat = self._chat_keys(value)
+        if group_b_chat is not None:
+            self._by_group_b_chat[group_b_chat].add(key)
+            if group_b_msg is not None:
+                self._by_group_b_msg[(group_b_chat, group_b_msg)] = key
+            if number is not None:
+                self._by_number[(group_b_chat, number)].add(key)
+        if group_a_chat is not None:
+            self._by_group_a_chat[group_a_chat].add(key)
+
+    def _unindex(self, key, value) -> None:
+        group_b_chat, group_b_msg, number, group_a_chat = self._chat_keys(value)
+        if self._by_group_b_msg.get((group_b_chat, group_b_msg)) == key:
+            del self._by_group_b_msg[(group_b_chat, group_b_msg)]
+        for index, index_key in ((self._by_number, (group_b_chat, number)),
+                                 (self._by_group_b_chat, group_b_chat),
+                                 (self._by_group_a_chat, group_a_chat)):
+            keys = index.get(index_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[index_key]
+
+    def find_by_group_b_msg(self, group_b_chat_id, group_b_msg_id) -> Optional[Tuple[Any, Dict]]:
+        """Find the (image_id, mapping) whose Group B message is group_b_msg_id."""
+        with self._lock:
+            key = self._by_group_b_msg.get((_message_id(group_b_chat_id), _message_id(group_b_msg_id)))
+            value = None if key is None else self.get(key)
+            return None if value is None else (key, value)
+
+    def keys_for_number(self, group_b_chat_id, number) -> List:
+        """Image IDs of the mappings for a number in a Group B chat."""
+        with self._lock:
+            return list(self._by_number.get((_message_id(group_b_chat_id), str(number)), ()))
+
+    def keys_for_group_b_chat(self, group_b_chat_id) -> List:
+        """Image IDs of the mappings sent to a Group B chat."""
+        with self._lock:
+            return list(self._by_group_b_chat.get(_message_id(group_b_chat_id), ()))
+
+    def keys_for_group_a_chat(self, group_a_chat_id) -> List:
+        """Image IDs of the mappings requested from a Group A chat."""
+        with self._lock:
+            return list(self._by_group_a_chat.get(_message_id(group_a_chat_id), ()))
+
+    def remove_keys(self, keys) -> Dict:
+        """Remove the given image IDs, returning the removed {image_id: mapping}."""
+        removed = {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.pop(key, None)
+                if entry is not None:
+                    self._unindex(key, entry[0])
+                    removed[key] = entry[0]
+        return removed
+
+    def remove_group_b_chat(self, group_b_chat_id) -> Dict:
+        """Remove every mapping of a Group B chat, touching only that chat's entries."""
+        with self._lock:
+            return self.remove_keys(self.keys_for_group_b_chat(group_b_chat_id))